@@ -1,5 +1,11 @@
 import re
+import sys
 import json
+import functools
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # CDX(J) formats supported
 FORMAT_UNKNOWN = 0
@@ -7,6 +13,111 @@ FORMAT_CDX7 = 1
 FORMAT_CDXJ = 2
 FORMAT_CDXNbams = 3
 FORMAT_CDXNbamskrMSVg = 4
+FORMAT_CDXNbamsS = 5
+
+# Fields of the records returned by CdxParser.parse()
+R_DATE      = 0
+R_AGG       = 1
+R_SCHEME    = 2
+R_MIME      = 3
+R_LENGTH    = 4
+# number of distinct SURT host parts (or hosts) whose aggregation key is remembered
+AGG_CACHE_SIZE = 65536
+# number of hosts whose registrable domain is remembered
+PSL_CACHE_SIZE = 65536
+# the PublicSuffixList, loaded on first use
+PublicSuffix = None
+
+# returns the PublicSuffixList of the publicsuffixlist module, which is only needed (and loaded)
+# when the hosts are aggregated by registrable domain
+def public_suffix_list():
+    global PublicSuffix
+    if PublicSuffix is None:
+        from publicsuffixlist import PublicSuffixList
+        PublicSuffix = PublicSuffixList()
+    return PublicSuffix
+
+# returns the registrable domain (public suffix and one more label, e.g. example.co.uk) of the host,
+# or the host itself if it has none (e.g. a public suffix or an IP address)
+@functools.lru_cache(maxsize=PSL_CACHE_SIZE)
+def private_suffix(host):
+    ret = public_suffix_list().privatesuffix(host)
+    if ret:
+        return ret
+    return host
+
+# Results of LineFilter.check()
+F_ACCEPT    = 0
+F_REJECT    = 1
+# the key of the line is after all the key ranges, on sorted input no line after it is accepted
+F_PAST      = 2
+
+# the first key that does not start with prefix
+def prefix_end(prefix):
+    return prefix[0:-1] + chr(ord(prefix[-1]) + 1)
+
+# the SURT prefix of a TLD or domain suffix, e.g. "lu," for "lu" and "uk,co," for "co.uk"
+def surt_of_tld(tld):
+    return ','.join(reversed(tld.strip('.').lower().split('.'))) + ','
+
+# returns the sorted list of SURT key ranges [start, end[ (end None: no limit) of the lines in the range
+# [key_from, key_to[ that start with prefix and with one of the prefixes of the tlds, None if all keys are in
+def key_ranges(key_from=None, key_to=None, prefix=None, tlds=None):
+    if not (key_from or key_to or prefix or tlds):
+        return None
+    start = key_from or ''
+    end = key_to
+    if prefix:
+        start = max(start, prefix)
+        end = prefix_end(prefix) if end is None else min(end, prefix_end(prefix))
+    ranges = []
+    for p in sorted(set(surt_of_tld(tld) for tld in tlds)) if tlds else [None]:
+        r = (start, end) if p is None else (max(start, p), prefix_end(p) if end is None else min(end, prefix_end(p)))
+        if r[1] is None or r[0] < r[1]:
+            ranges.append(r)
+    return ranges
+
+# Cheap checks of a raw line before it is parsed: the start of the line (the SURT key) is compared
+# with the key ranges and a slice of the timestamp with the dates (YYYY, YYYYMM, ..., both included).
+# For the formats whose key is not a SURT (cdxNbams) the TLDs are compared with the end of the host.
+# Lines that do not look like the format are accepted and left to the parser
+class LineFilter:
+    def __init__(self, ranges=None, from_date=None, to_date=None, tlds=None):
+        self.ranges = ranges
+        self.end = None
+        if ranges and all(r[1] is not None for r in ranges):
+            self.end = max(r[1] for r in ranges)
+        self.host_suffixes = tuple('.' + tld.strip('.').lower() for tld in tlds) if tlds else None
+        self.from_date = from_date
+        self.to_date = to_date
+
+    def check(self, line):
+        if self.ranges is not None:
+            for start, end in self.ranges:
+                if line >= start and (end is None or line < end):
+                    break
+            else:
+                if self.end is not None and line >= self.end:
+                    return F_PAST
+                return F_REJECT
+        elif self.host_suffixes is not None:
+            p = len(line)
+            for c in ('/', ':', ' '):
+                pc = line.find(c, 0, p)
+                if pc > -1:
+                    p = pc
+            if not line[0:p].lower().endswith(self.host_suffixes):
+                return F_REJECT
+        if self.from_date or self.to_date:
+            p = line.find(' ')
+            ts = line[p + 1:p + 15]
+            if p < 1 or not ts[0:4].isdecimal():
+                return F_ACCEPT
+            if self.from_date and ts[0:len(self.from_date)] < self.from_date:
+                return F_REJECT
+            if self.to_date and ts[0:len(self.to_date)] > self.to_date:
+                return F_REJECT
+        return F_ACCEPT
 
 class CdxParser:
     # ----- Regular expressions for the CDX formats
@@ -47,6 +158,16 @@ class CdxParser:
     # S comp. record size   size
     reExprCDX7 = r'^(?P<surt>([^ ):,]+)(,[^ ):,]+)*)(?:[):]\S*\s+|\s+)(?P<year>[0-9][0-9][0-9][0-9])(?P<month>[0-9][0-9])\d+\s+(?:(?P<scheme>https?)://)?\S+\s+(?P<mime>\S+)\s+(?P<status>\S+)\s+\S+\s+(?P<length>\S+)'
 
+    # CDX N b a m s S
+    # reduced lines returned by OutbackCDX for the fields used (fl=urlkey,timestamp,original,mimetype,statuscode,length)
+    # N massaged url        surt
+    # b date                year + month
+    # a original url        scheme
+    # m mime type           mime
+    # s response code       status
+    # S comp. record size   size
+    reExprCDXNbamsS = r'^(?P<surt>([^ ):,]+)(,[^ ):,]+)*)(?:[):]\S*\s+|\s+)(?P<year>[0-9][0-9][0-9][0-9])(?P<month>[0-9][0-9])\d+\s+(?:(?P<scheme>https?)://)?\S+\s+(?P<mime>\S+)\s+(?P<status>\S+)\s+(?P<length>\S+)'
+
     # CDXJ
     # format used by pywb and returned by the common crawl
     # N massaged url        surt
@@ -54,26 +175,43 @@ class CdxParser:
     # JSON					data
     reExprCDXJ = r'^(?P<surt>([^ ):,]+)(,[^ ):,]+)*)(?:[):]\S*\s+|\s+)(?P<year>[0-9][0-9][0-9][0-9])(?P<month>[0-9][0-9])\d+\s+(?P<data>.*$)'
 
-    def __init__(self, format, monthly=False, fullhost=False):
+
+    # the aggregation key is the second level domain, the full host with fullhost or the registrable
+    # domain with publicsuffix
+    def __init__(self, format, monthly=False, fullhost=False, publicsuffix=False):
         self.monthly = monthly
         self.fullhost = fullhost
+        self.publicsuffix = publicsuffix
         self.only200 = True
         if format == FORMAT_CDX7:
             self.re_line = re.compile(self.reExprCDX7)
             self.has_json = False
             self.surt = True
+            self.parse = self.parse_cdx7
         elif format == FORMAT_CDXJ:
             self.re_line = re.compile(self.reExprCDXJ)
             self.has_json = True
             self.surt = True
+            self.parse = self.parse_cdxj
         elif format == FORMAT_CDXNbams:
             self.re_line = re.compile(self.reExprCDXNbams)
             self.has_json = False
             self.surt = False
+            self.parse = self.parse_cdxNbams
         elif format == FORMAT_CDXNbamskrMSVg:
             self.re_line = re.compile(self.reExprCDXNbamskrMSVg)
             self.has_json = False
             self.surt = True
+            self.parse = self.parse_cdxNbamskrMSVg
+        elif format == FORMAT_CDXNbamsS:
+            self.re_line = re.compile(self.reExprCDXNbamsS)
+            self.has_json = False
+            self.surt = True
+            self.parse = self.parse_cdxNbamsS
+        # aggregation key of the SURT host part (or host) of the previous line and cache of the recent ones
+        self.last_key = None
+        self.last_agg = None
+        self.agg_cache = functools.lru_cache(maxsize=AGG_CACHE_SIZE)(self.new_agg)
 
     def agg_from_surt(self, surt):
         parts = surt.split(',')
@@ -93,54 +231,267 @@ class CdxParser:
             return host[p1+1:]
         return host
 
+    # returns the interned aggregation key of a SURT host part (or host for cdxNbams)
+    def new_agg(self, key):
+        if self.publicsuffix:
+            if self.surt:
+                parts = key.split(',')
+                parts.reverse()
+                key = '.'.join(parts)
+            return sys.intern(private_suffix(key))
+        if self.surt:
+            return sys.intern(self.agg_from_surt(key))
+        if self.fullhost:
+            return sys.intern(key)
+        return sys.intern(self.lvl2_from_host(key))
+
+    # returns the aggregation key of a SURT host part (or host for cdxNbams), the key of the previous
+    # line is reused while the host does not change (sorted input), otherwise it comes from the cache.
+    # All the records of an aggregation key share the same string
+    def agg_of(self, key):
+        if key != self.last_key:
+            self.last_key = key
+            self.last_agg = self.agg_cache(key)
+        return self.last_agg
+
+    # returns the dictionary {'date', 'agg', 'scheme', 'mime', 'length'} or {} if the line is not counted
     def parse_line(self, line):
+        r = self.parse(line)
+        if r is None:
+            return {}
+        return {'date' : r[R_DATE], 'agg' : r[R_AGG], 'scheme': r[R_SCHEME], 'mime': r[R_MIME], 'length' : r[R_LENGTH]}
+
+    # ----- Fast parsers for the space delimited formats
+    # They split the line once and only check the fields that are used. Anything
+    # that does not look like a regular line is handed to parse_regex, so that the
+    # results are the same as with the regular expressions
+    def parse_surt_tokens(self, line, nmin, ilength):
+        tokens = line.split(None, nmin)
+        if len(tokens) < nmin or line[0:1].isspace():
+            return self.parse_regex(line)
+        # N: the surt ends at the first ')', empty parts or a port are left to the regex
+        key = tokens[0]
+        p = key.find(')')
+        surt = key[0:p]
+        if p < 1 or ':' in surt or surt[0] == ',' or surt[-1] == ',' or ',,' in surt:
+            return self.parse_regex(line)
+        # b: 14 digit timestamp
+        ts = tokens[1]
+        if len(ts) < 7 or not ts.isdecimal() or not ts.isascii():
+            return self.parse_regex(line)
+        if self.only200 and tokens[4][0:1] != '2':
+            return None
+        mime = tokens[3]
+        if mime == 'application/warc-fields':
+            return None
+        if self.monthly:
+            date = int(ts[0:6])
+        else:
+            date = int(ts[0:4])
+        url = tokens[2]
+        if url[0:7] == 'http://' and len(url) > 7:
+            scheme = 'http'
+        elif url[0:8] == 'https://' and len(url) > 8:
+            scheme = 'https'
+        else:
+            scheme = None
+        length = tokens[ilength]
+        if surt != self.last_key:
+            self.last_key = surt
+            self.last_agg = self.agg_cache(surt)
+        return (date, self.last_agg, scheme, mime, int(length) if length.isnumeric() else 0)
+
+    def parse_cdx7(self, line):
+        return self.parse_surt_tokens(line, 7, 6)
+
+    def parse_cdxNbamskrMSVg(self, line):
+        return self.parse_surt_tokens(line, 9, 8)
+
+    def parse_cdxNbamsS(self, line):
+        return self.parse_surt_tokens(line, 6, 5)
+
+    def parse_cdxNbams(self, line):
+        tokens = line.split(None, 5)
+        if len(tokens) < 5 or line[0:1].isspace():
+            return self.parse_regex(line)
+        # N: the host ends at the first '/' or ':'
+        key = tokens[0]
+        p = key.find('/')
+        if p == -1:
+            p = len(key)
+        pc = key.find(':', 0, p)
+        if pc > -1:
+            p = pc
+        ts = tokens[1]
+        if p == 0 or len(ts) < 7 or not ts.isdecimal() or not ts.isascii():
+            return self.parse_regex(line)
+        if self.only200 and tokens[4][0:1] != '2':
+            return None
+        mime = tokens[3]
+        if mime == 'application/warc-fields':
+            return None
+        if self.monthly:
+            date = int(ts[0:6])
+        else:
+            date = int(ts[0:4])
+        url = tokens[2]
+        if url[0:7] == 'http://' and len(url) > 7:
+            scheme = 'http'
+        elif url[0:8] == 'https://' and len(url) > 8:
+            scheme = 'https'
+        else:
+            scheme = None
+        return (date, self.agg_of(key[0:p]), scheme, mime, 0)
+
+    # CDXJ: the JSON data is decoded with orjson if it is installed (much faster than
+    # json.loads), lines that can't be decoded go through parse_regex and json.loads
+    def parse_cdxj(self, line):
+        tokens = line.split(None, 2)
+        if len(tokens) < 3 or line[0:1].isspace():
+            return self.parse_regex(line)
+        key = tokens[0]
+        p = key.find(')')
+        surt = key[0:p]
+        if p < 1 or ':' in surt or surt[0] == ',' or surt[-1] == ',' or ',,' in surt:
+            return self.parse_regex(line)
+        ts = tokens[1]
+        if len(ts) < 7 or not ts.isdecimal() or not ts.isascii():
+            return self.parse_regex(line)
+        data = tokens[2]
+        p = data.find('\n')
+        if p > -1 and p < len(data) - 1:
+            return self.parse_regex(line)
+        d = self.json_fields(data)
+        if d is None:
+            return self.parse_regex(line)
+        if self.monthly:
+            date = int(ts[0:6])
+        else:
+            date = int(ts[0:4])
+        return self.record_from_json(date, self.agg_of(surt), d)
+
+    # returns the decoded JSON data or None if it can't be decoded here
+    def json_fields(self, data):
+        try:
+            if orjson is not None:
+                d = orjson.loads(data)
+            else:
+                d = json.loads(data)
+        except ValueError:
+            return None
+        if type(d) is dict:
+            return d
+        return None
+
+    def record_from_json(self, retdate, retagg, d):
+        if self.only200 and 'status' in d and d['status'][0:1] != '2':
+            return None
+        # some CDXJ files have metadata records, do not count those
+        if 'mime' in d and d['mime']=='application/warc-fields':
+            return None
+        retsize = 0
+        if 'length' in d and d['length'].isnumeric():
+            retsize = int(d['length'])
+        retscheme = ''
+        if 'url' in d and len(d['url']) >= 8:
+            if d['url'][0:7] == 'http://':
+                retscheme = 'http'
+            elif d['url'][0:8] == 'https://':
+                retscheme = 'https'
+        retmime = 'unknown'
+        if 'mime' in d:
+            retmime = d['mime']
+        return (retdate, retagg, retscheme, retmime, retsize)
+
+    # ----- Batch parsers
+    # returns the list of the records of the lines that are counted, the same as parse() for each line
+    def parse_many(self, lines):
+        if self.parse == self.parse_cdx7:
+            return self.parse_many_surt_tokens(lines, 7, 6)
+        if self.parse == self.parse_cdxNbamskrMSVg:
+            return self.parse_many_surt_tokens(lines, 9, 8)
+        if self.parse == self.parse_cdxNbamsS:
+            return self.parse_many_surt_tokens(lines, 6, 5)
+        parse = self.parse
+        ret = []
+        append = ret.append
+        for line in lines:
+            rec = parse(line)
+            if rec is not None:
+                append(rec)
+        return ret
+
+    # same as parse_surt_tokens for each line, in a single loop with the attributes in local variables
+    def parse_many_surt_tokens(self, lines, nmin, ilength):
+        parse_regex = self.parse_regex
+        agg_cache = self.agg_cache
+        only200 = self.only200
+        ndate = 6 if self.monthly else 4
+        last_key = self.last_key
+        last_agg = self.last_agg
+        ret = []
+        append = ret.append
+        for line in lines:
+            tokens = line.split(None, nmin)
+            key = tokens[0] if tokens else ''
+            p = key.find(')')
+            surt = key[0:p]
+            ts = tokens[1] if len(tokens) > 1 else ''
+            if (len(tokens) < nmin or line[0:1].isspace() or p < 1 or ':' in surt or surt[0] == ',' or surt[-1] == ','
+                    or ',,' in surt or len(ts) < 7 or not ts.isdecimal() or not ts.isascii()):
+                rec = parse_regex(line)
+                if rec is not None:
+                    append(rec)
+                continue
+            if only200 and tokens[4][0:1] != '2':
+                continue
+            mime = tokens[3]
+            if mime == 'application/warc-fields':
+                continue
+            url = tokens[2]
+            if url[0:7] == 'http://' and len(url) > 7:
+                scheme = 'http'
+            elif url[0:8] == 'https://' and len(url) > 8:
+                scheme = 'https'
+            else:
+                scheme = None
+            if surt != last_key:
+                last_key = surt
+                last_agg = agg_cache(surt)
+            length = tokens[ilength]
+            append((int(ts[0:ndate]), last_agg, scheme, mime, int(length) if length.isnumeric() else 0))
+        self.last_key = last_key
+        self.last_agg = last_agg
+        return ret
+
+    # ----- Generic parser using the regular expression of the format
+    # returns the tuple (date, agg, scheme, mime, length) or None if the line is not counted
+    def parse_regex(self, line):
         m = self.re_line.match(line)
         if m:
             vars = m.groupdict()
             if self.only200 and 'status' in vars and vars['status'][0:1] != '2':
-                return {}
-            ret = {}
+                return None
             # some CDX files might have metadata records, do not count those
             if 'mime' in vars and vars['mime']=='application/warc-fields':
-                return {}
+                return None
             # the date can be just YYYY or YYYYMM
             if self.monthly:
                 retdate = int(vars['year'] + vars['month'])
             else:
                 retdate = int(vars['year'])
-            # Aggregation key is either the second level domain or the full host
+            # Aggregation key is either the second level domain, the full host or the registrable domain
             if self.surt:
-                retagg = self.agg_from_surt(vars['surt'])
+                retagg = self.agg_of(vars['surt'])
             else:
-                if self.fullhost:
-                    retagg = vars['host']
-                else:
-                    retagg = self.lvl2_from_host(vars['host'])
+                retagg = self.agg_of(vars['host'])
             # line has embedded JSON
             if self.has_json:
-                d = json.loads(vars['data'])
-                if self.only200 and 'status' in d and d['status'][0:1] != '2':
-                    return {}
-                # some CDXJ files have metadata records, do not count those
-                if 'mime' in d and d['mime']=='application/warc-fields':
-                    return {}
-                retsize = 0
-                if 'length' in d and d['length'].isnumeric():
-                    retsize = int(d['length'])
-                retscheme = ''
-                if 'url' in d and len(d['url']) >= 8:
-                    if d['url'][0:7] == 'http://':
-                        retscheme = 'http'
-                    elif d['url'][0:8] == 'https://':
-                        retscheme = 'https'
-                retmime = 'unknown'
-                if 'mime' in d:
-                    retmime = d['mime']
-                return {'date' : retdate, 'agg' : retagg, 'scheme': retscheme, 'mime': retmime, 'length' : retsize}
+                return self.record_from_json(retdate, retagg, json.loads(vars['data']))
             else:
                 # line comes fully from the regex
                 retsize = 0
                 if 'length' in vars and vars['length'].isnumeric():
                     retsize = int(vars['length'])
-                return {'date' : retdate, 'agg' : retagg, 'scheme': vars['scheme'], 'mime': vars['mime'], 'length' : retsize}
-        return {}
+                return (retdate, retagg, vars['scheme'], vars['mime'], retsize)
+        return None
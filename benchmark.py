@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+from argparse import ArgumentParser
+import sys
+import os
+import gzip
+import time
+import importlib
+import tracemalloc
+import tempfile
+import argparse
+import contextlib
+import CdxParser
+import mime_counter
+import host_table
+import summary_file
+cdxsummarize = importlib.import_module('cdx-summarize')
+cdxcombine = importlib.import_module('combine-summary')
+
+def print_to_stderr(*a):
+    print(*a, file = sys.stderr)
+
+def read_lines(args, filename):
+    if filename[-3:] == '.gz':
+        with gzip.open(filename, mode='rt', encoding='utf-8') as f:
+            return f.readlines()
+    with open(filename, 'r', encoding='utf-8') as f:
+        return f.readlines()
+
+def measure(name, nlines, func, *a):
+    start = time.perf_counter()
+    func(*a)
+    elapsed = time.perf_counter() - start
+    print('%-30s %10.3f s %12.0f lines/s' % (name, elapsed, nlines / elapsed if elapsed > 0 else 0))
+    return elapsed
+
+def run_parser(parse, lines):
+    for line in lines:
+        parse(line)
+
+# compare the regular expression parser with the fast path for the format of the file
+def bench_parser(args):
+    for filename in args.file:
+        lines = read_lines(args, filename)
+        ftype = cdxsummarize.determine_cdx_type(lines[0])
+        if ftype == CdxParser.FORMAT_UNKNOWN and len(lines) > 1:
+            ftype = cdxsummarize.determine_cdx_type(lines[1])
+        if ftype == CdxParser.FORMAT_UNKNOWN:
+            print_to_stderr("Unsupported cdx format: ", filename)
+            continue
+        parser = CdxParser.CdxParser(ftype, args.monthly, args.fullhost)
+        print(filename, len(lines), 'lines')
+        best_regex = min(measure('regex (parse_regex)', len(lines), run_parser, parser.parse_regex, lines) for i in range(args.repeat))
+        best_fast = min(measure('fast path (parse)', len(lines), run_parser, parser.parse, lines) for i in range(args.repeat))
+        print('speedup: %.2fx' % (best_regex / best_fast))
+
+def parse_file(args, filename):
+    lines = read_lines(args, filename)
+    ftype = cdxsummarize.determine_cdx_type(lines[0])
+    if ftype == CdxParser.FORMAT_UNKNOWN and len(lines) > 1:
+        ftype = cdxsummarize.determine_cdx_type(lines[1])
+    if ftype == CdxParser.FORMAT_UNKNOWN:
+        print_to_stderr("Unsupported cdx format: ", filename)
+        return []
+    parser = CdxParser.CdxParser(ftype, args.monthly, args.fullhost)
+    return [r for r in map(parser.parse, lines) if r is not None]
+
+def run_add_mime(category, mimes):
+    a = mime_counter.init_counter()
+    for mime in mimes:
+        i = category(mime)
+        a[mime_counter.N_TOTAL] += 1
+        a[i] += 1
+
+# compare the media type classification with and without the cache
+def bench_mime(args):
+    for filename in args.file:
+        mimes = [r[CdxParser.R_MIME] for r in parse_file(args, filename)]
+        print(filename, len(mimes), 'records')
+        best_chain = min(measure('uncached', len(mimes), run_add_mime, mime_counter.mime_category.__wrapped__, mimes) for i in range(args.repeat))
+        best_cache = min(measure('cached', len(mimes), run_add_mime, mime_counter.mime_category, mimes) for i in range(args.repeat))
+        hits, misses, size = mime_counter.cache_stats()
+        print('cache: %d hits, %d misses, %d entries' % (hits, misses, size))
+        print('speedup: %.2fx' % (best_chain / best_cache))
+
+# the table used before host_table: dict of dicts of lists
+def build_dict_table(records):
+    hosts = {}
+    for rec in records:
+        agg = rec[CdxParser.R_AGG]
+        if not agg in hosts:
+            hosts[agg] = {}
+        date = rec[CdxParser.R_DATE]
+        if not date in hosts[agg]:
+            hosts[agg][date] = mime_counter.init_counter()
+        mime_counter.add_mime(hosts[agg][date], rec[CdxParser.R_MIME], 1, rec[CdxParser.R_LENGTH])
+        mime_counter.add_scheme(hosts[agg][date], rec[CdxParser.R_SCHEME], 1, rec[CdxParser.R_LENGTH])
+    return hosts
+
+def build_host_table(records):
+    hosts = host_table.HostTable()
+    for rec in records:
+        hosts.add_record(rec[CdxParser.R_AGG], rec[CdxParser.R_DATE], rec[CdxParser.R_MIME], rec[CdxParser.R_SCHEME], rec[CdxParser.R_LENGTH])
+    return hosts
+
+def measure_memory(name, build, records):
+    tracemalloc.start()
+    table = build(records)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if isinstance(table, dict):
+        ncells = sum(len(v) for v in table.values())
+    else:
+        ncells = table.ncells()
+    print('%-30s %10d cells %8.1f bytes/cell (peak %.1f)' % (name, ncells, current / ncells, peak / ncells))
+
+# compare the memory used per (host, date) cell by the aggregation tables
+def bench_memory(args):
+    records = []
+    for filename in args.file:
+        records.extend(parse_file(args, filename))
+    print(len(records), 'records')
+    measure_memory('dict of lists', build_dict_table, records)
+    measure_memory('host_table.HostTable', build_host_table, records)
+
+def read_all(read, filename):
+    for host, dates in read(filename):
+        pass
+
+# compare reading a .summary file (JSONL) with reading the same data in the binary format
+def bench_summary(args):
+    for filename in args.file:
+        nhosts = sum(1 for entry in summary_file.read_jsonl(filename))
+        binname = filename + '.bin'
+        with summary_file.SummaryWriter(binname) as writer:
+            for host, dates in summary_file.read_jsonl(filename):
+                writer.add(host, dates)
+        print(filename, nhosts, 'hosts,', os.path.getsize(filename), 'bytes JSONL,', os.path.getsize(binname), 'bytes binary')
+        best_json = min(measure('JSONL (read_jsonl)', nhosts, read_all, summary_file.read_jsonl, filename) for i in range(args.repeat))
+        best_bin = min(measure('binary (SummaryReader)', nhosts, read_all, summary_file.SummaryReader, binname) for i in range(args.repeat))
+        os.remove(binname)
+        print('speedup: %.2fx' % (best_json / best_bin))
+
+# the merge used by combine-summary --assume_unique before the heap: the list of files is sorted again after each entry
+def merge_by_sorting(iterators):
+    fil = []
+    for it in iterators:
+        entry = next(it, None)
+        fil.append({'it': it, 'eof': 'Z' if entry is None else 'A', 'host': '' if entry is None else entry[0]})
+    fil.sort(key=lambda x:x['eof']+x['host'])
+    while fil and fil[0]['eof'] == 'A':
+        entry = next(fil[0]['it'], None)
+        if entry is None:
+            fil[0]['eof'] = 'Z'
+        else:
+            fil[0]['host'] = entry[0]
+        fil.sort(key=lambda x:x['eof']+x['host'])
+
+def merge_by_heap(iterators):
+    for entry in cdxcombine.merge_entries(iterators, lambda host: host):
+        pass
+
+def combine_sorted(filenames):
+    args = argparse.Namespace(yearly=False, compact=False, aggregatehosts=None, assume_unique=True, binary=None, file=filenames)
+    with open(os.devnull, 'w') as out, contextlib.redirect_stdout(out):
+        cdxcombine.read_sorted(args)
+
+# split the entries of the summary files into 1, 2, 4 ... sorted files and merge them, the
+# ordering alone (entries already in memory) with the heap and with the list sorted after each
+# entry, then the whole combine-summary --assume_unique
+def bench_merge(args):
+    lines = []
+    for filename in args.file:
+        with open(filename, 'r', errors="ignore") as f:
+            lines.extend(f.readlines())
+    lines.sort(key=lambda line: line[0:line.find(' ')])
+    hosts = [(line[0:line.find(' ')], None) for line in lines]
+    print(len(lines), 'entries')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        k = 1
+        while k <= args.max_files:
+            min(measure('%4d files ordering, heap' % k, len(hosts), merge_by_heap, [iter(hosts[i::k]) for i in range(k)]) for r in range(args.repeat))
+            min(measure('%4d files ordering, sorting' % k, len(hosts), merge_by_sorting, [iter(hosts[i::k]) for i in range(k)]) for r in range(args.repeat))
+            filenames = []
+            for i in range(k):
+                filenames.append(os.path.join(tmpdir, '%d.summary' % i))
+                with open(filenames[-1], 'w') as f:
+                    f.writelines(lines[i::k])
+            min(measure('%4d files combine-summary' % k, len(lines), combine_sorted, filenames) for r in range(args.repeat))
+            k *= 2
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure the throughput of parts of the summarization on sample files')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is used (default 3)')
+    parser.add_argument('--monthly', action="store_true", help='use monthly buckets')
+    parser.add_argument('--fullhost', action="store_true", default=False, help='aggregate by full hostname')
+    parser.add_argument('benchmark', choices=['parser', 'mime', 'memory', 'summary', 'merge'], help='what to measure')
+    parser.add_argument('--max_files', type=int, default=256, help='merge benchmark: biggest number of files to merge (default 256)')
+    parser.add_argument('file', nargs='*', help='sample file (can be several), .summary files for the summary and merge benchmarks')
+    args = parser.parse_args()
+    if args.benchmark == 'parser':
+        bench_parser(args)
+    elif args.benchmark == 'mime':
+        bench_mime(args)
+    elif args.benchmark == 'memory':
+        bench_memory(args)
+    elif args.benchmark == 'summary':
+        bench_summary(args)
+    elif args.benchmark == 'merge':
+        bench_merge(args)
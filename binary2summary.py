@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+from argparse import ArgumentParser
+import sys
+import json
+import mime_counter
+import summary_file
+
+def print_to_stderr(*a):
+	print(*a, file = sys.stderr)
+
+def addFile(args, filename):
+	with summary_file.SummaryReader(filename) as reader:
+		for host, dates in reader:
+			r = {}
+			for year, values in dates:
+				r[year] = mime_counter.as_dict(values)
+				if args.compact:
+					r[year] = {k: v for k, v in r[year].items() if v > 0}
+			print(host, json.dumps(r))
+
+def dowork(args):
+	for f in args.file:
+		try:
+			addFile(args, f)
+		except Exception as inst:
+			print_to_stderr("Error", inst, f)
+
+parser = ArgumentParser(description='convert binary summary file(s) to the JSONL summary format')
+parser.add_argument('--compact', action="store_true", help='do not output fields that are 0')
+parser.add_argument('file', nargs='*', help='binary summary file (can be several)')
+
+args = parser.parse_args()
+dowork(args)
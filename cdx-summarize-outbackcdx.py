@@ -1,29 +1,163 @@
 #!/usr/bin/python3
 from argparse import ArgumentParser
 import sys
-import urllib
+import os
+import json
+import time
+import urllib.parse
 import importlib
+import concurrent.futures
 import CdxParser
+import host_table
+import mime_counter
 import requests
 cdxsummarize = importlib.import_module('cdx-summarize')
-ftype = CdxParser.FORMAT_CDXNbamskrMSVg
 
-def read_url(args, url):
-    parser = CdxParser.CdxParser(ftype, args.monthly, args.fullhost)
+# With --server_filter, the server drops the records that are not counted (status other than 2xx,
+# metadata records) and only sends the fields used, the lines are then in the cdxNbamsS format
+SERVER_FIELDS = 'urlkey,timestamp,original,mimetype,statuscode,length'
+SERVER_FILTERS = ['statuscode:2.*', '!mimetype:application/warc-fields']
+
+def print_to_stderr(*a):
+    print(*a, file = sys.stderr)
+
+# one session for all the requests, its connection pool holds up to --concurrency connections
+def make_session(args):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def cdx_type(args):
+    if args.server_filter:
+        return CdxParser.FORMAT_CDXNbamsS
+    return CdxParser.FORMAT_CDXNbamskrMSVg
+
+def read_url(args, session, url):
+    parser = CdxParser.CdxParser(cdx_type(args), args.monthly, args.fullhost, args.publicsuffix)
     aggregate_by = ''
-    with requests.get(url, stream=True) as r:
+    with session.get(url, stream=True, timeout=args.timeout) as r:
         for line in r.iter_lines(decode_unicode=True):
-            res = parser.parse_line(line)
-            cdxsummarize.summarize_line(res)
+            rec = parser.parse(line)
+            cdxsummarize.summarize_record(rec)
             if args.assume_unique:
-                if 'agg' in res and res['agg'] != aggregate_by and aggregate_by != '':
+                if rec is not None and rec[CdxParser.R_AGG] != aggregate_by:
                     cdxsummarize.output_partial_results(args, aggregate_by)
-                    aggregate_by = res['agg']
+                    aggregate_by = rec[CdxParser.R_AGG]
+
+# the SURT key ranges [start, end[ of a collection, split at the keys of --split_key
+def key_ranges(args):
+    keys = [''] + sorted(args.split_key) + [None]
+    return list(zip(keys[0:-1], keys[1:]))
+
+def range_url(args, collection, start):
+    query = [('url', start), ('matchType', 'range')]
+    if args.server_filter:
+        query += [('fl', SERVER_FIELDS)] + [('filter', f) for f in SERVER_FILTERS]
+    return args.url + '/' + collection + '?' + urllib.parse.urlencode(query)
+
+# With --checkpoint, each key range regularly saves its table and the last SURT key it has
+# completely read to a file, --resume reads the files and restarts the range after that key
+def checkpoint_filename(args, collection, i):
+    return os.path.join(args.checkpoint, urllib.parse.quote(collection, safe='') + '-' + str(i) + '.checkpoint')
+
+# the first line holds the range and the last key read (done), the other lines the table as in a .summary file
+def save_checkpoint(args, filename, collection, start, end, done, finished, hosts):
+    with open(filename + '.tmp', 'w', encoding='utf-8') as out:
+        print(json.dumps({'collection': collection, 'start': start, 'end': end, 'done': done, 'finished': finished}), file=out)
+        for agg in hosts.hosts():
+            print(agg, json.dumps(cdxsummarize.dates_as_dict(hosts.dates(agg), True)), file=out)
+    os.replace(filename + '.tmp', filename)
+
+# returns (done, finished, table) of the checkpoint of the range or None
+def load_checkpoint(args, filename, collection, start, end):
+    if not os.path.exists(filename):
+        return None
+    hosts = host_table.HostTable()
+    with open(filename, 'r', encoding='utf-8') as fil:
+        state = json.loads(fil.readline())
+        if state['collection'] != collection or state['start'] != start or state['end'] != end:
+            print_to_stderr("Checkpoint", filename, "is for another key range, starting again from", repr(start))
+            return None
+        for line in fil:
+            p = line.find(' ')
+            agg = line[0:p]
+            for date, values in json.loads(line[p+1:]).items():
+                hosts.add_counter(agg, int(date), mime_counter.from_dict(values))
+    return state['done'], state['finished'], hosts
+
+# runs in a thread: summarize the key range [start, end[ of a collection into its own table
+# the query starts at start, lines before start are skipped in case the server returns them
+# anyway and the stream is closed at the first key after the range
+def read_range(args, session, collection, i, start, end):
+    parser = CdxParser.CdxParser(cdx_type(args), args.monthly, args.fullhost, args.publicsuffix)
+    hosts = host_table.HostTable()
+    # all the lines up to the key done are in the table
+    done = None
+    if args.checkpoint:
+        filename = checkpoint_filename(args, collection, i)
+        state = load_checkpoint(args, filename, collection, start, end) if args.resume else None
+        if state is not None:
+            done, finished, hosts = state
+            if finished:
+                return hosts
+        last_save = time.monotonic()
+    key = None
+    with session.get(range_url(args, collection, start if done is None else done), stream=True, timeout=args.timeout) as r:
+        r.raise_for_status()
+        for line in r.iter_lines(decode_unicode=True):
+            p = line.find(' ')
+            if line[0:p] != key:
+                # all the lines of the previous key have been read
+                if key is not None:
+                    done = key
+                    if args.checkpoint and time.monotonic() - last_save > args.checkpoint_interval:
+                        save_checkpoint(args, filename, collection, start, end, done, False, hosts)
+                        last_save = time.monotonic()
+                key = line[0:p]
+            if key < start or (done is not None and key <= done):
+                continue
+            if end is not None and key >= end:
+                break
+            rec = parser.parse(line)
+            if rec is not None:
+                hosts.add_record(rec[CdxParser.R_AGG], rec[CdxParser.R_DATE], rec[CdxParser.R_MIME], rec[CdxParser.R_SCHEME], rec[CdxParser.R_LENGTH])
+    if args.checkpoint:
+        save_checkpoint(args, filename, collection, start, end, key, True, hosts)
+    return hosts
+
+# the collections and their key ranges are harvested by --concurrency threads, the partial
+# tables are merged in the order of the collections and ranges so that the output is the
+# same as when they are read one after the other
+def get_collections_concurrent(args, session, collections):
+    tasks = [(m, i, start, end) for m in collections for i, (start, end) in enumerate(key_ranges(args))]
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(read_range, args, session, m, i, start, end) for m, i, start, end in tasks]
+        for (m, i, start, end), future in zip(tasks, futures):
+            try:
+                cdxsummarize.Hosts.merge(future.result())
+            except Exception as inst:
+                failed = True
+                print_to_stderr("Error", inst, m, start, end)
+    if failed and args.checkpoint:
+        print_to_stderr("Some key ranges failed, the output is incomplete. Run again with --resume to continue them from their checkpoint")
+    cdxsummarize.output_results(args)
+    # the checkpoints are not needed anymore once everything has been output
+    if args.checkpoint and not failed:
+        for m, i, start, end in tasks:
+            os.remove(checkpoint_filename(args, m, i))
 
 def get_collections(args):
-    r = requests.get(args.url + '/api/collections')
-    for m in r.json():
-        read_url(args, args.url + '/' + m + '?url=&matchType=range')
+    session = make_session(args)
+    r = session.get(args.url + '/api/collections', timeout=args.timeout)
+    collections = r.json()
+    if args.concurrency > 1 or args.split_key or args.checkpoint:
+        get_collections_concurrent(args, session, collections)
+        return
+    for m in collections:
+        read_url(args, session, range_url(args, m, ''))
     cdxsummarize.output_results(args)
 
 def dowork(args):
@@ -34,7 +168,23 @@ if __name__ == '__main__':
     parser.add_argument('--monthly', action="store_true", help='break up statistics into monthly buckets instead of yearly')
     parser.add_argument('--compact', action="store_true", help='do not output fields that are 0')
     parser.add_argument('--fullhost', action="store_true", default=False, help='aggregate by full hostname instead of second level domain')
-    parser.add_argument('--assume_unique', action="store_true", default=False, help='assume aggregation entry only appears in a continous run in the CDX file(s) (OK for single, sorted CDX with --fullhost)')
+    parser.add_argument('--publicsuffix', action="store_true", default=False, help='aggregate by registrable domain (public suffix + 1, e.g. example.co.uk) instead of second level domain, needs the publicsuffixlist module')
+    parser.add_argument('--assume_unique', action="store_true", default=False, help='assume aggregation entry only appears in a continous run in the CDX file(s) (OK for single, sorted CDX with --fullhost, ignored with --concurrency, --split_key or --checkpoint)')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of collections or key ranges harvested at the same time, this is also the number of connections to the server (default 1)')
+    parser.add_argument('--split_key', action="append", default=[], metavar='KEY', help='SURT key at which each collection is split into key ranges harvested separately, e.g. "fr," (can be given several times)')
+    parser.add_argument('--timeout', type=float, default=300, help='timeout in seconds for connecting to the server and between the data received (default 300)')
+    parser.add_argument('--server_filter', '--server-filter', action="store_true", help='let the server drop the records that are not counted and only send the fields used (' + SERVER_FIELDS + ')')
+    parser.add_argument('--checkpoint', action="store", metavar='DIR', help='save the state of each collection or key range regularly to a file in DIR')
+    parser.add_argument('--checkpoint_interval', type=float, default=300, help='seconds between two checkpoints of a collection or key range (default 300)')
+    parser.add_argument('--resume', action="store_true", help='continue the collections and key ranges from their checkpoint in the --checkpoint directory')
     parser.add_argument('url', action="store", default='http://localhost:8084', help='url of OutbackCDX server')
     args = parser.parse_args()
-    dowork(args)
\ No newline at end of file
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+    if args.publicsuffix and args.fullhost:
+        parser.error('--publicsuffix and --fullhost can not be used together')
+    if args.publicsuffix:
+        CdxParser.public_suffix_list()
+    if args.checkpoint:
+        os.makedirs(args.checkpoint, exist_ok=True)
+    dowork(args)
@@ -1,19 +1,55 @@
 #!/usr/bin/python3
 from argparse import ArgumentParser
 import sys
+import os
 import gzip
+import io
 import json
+import tempfile
+import multiprocessing
+import heapq
+import hashlib
 import urllib
 import mime_counter
 import re
 import CdxParser
+import host_table
+import summary_file
+import line_reader
+import gzip_members
+import zipnum
+
+# Without --assume_unique, the lines are parsed and counted in batches of this many lines
+BATCH_LINES = 4096
+AGGREGATE_RETRY = 16
+AggregateBatches = True
+Batches = 0
 
 # Used to filter out invalid dates
 MIN_YEAR = 1991
 MAX_YEAR = 2022
 
-# Dictionary to hold the data per domain, per year (or yearmonth)
-Hosts = {}
+# Table holding the data per domain, per year (or yearmonth)
+Hosts = host_table.HostTable()
+
+# With --max_memory the table is written to a sorted run file when it gets too big,
+# the runs are merged at the end
+MaxMemory = 0
+SpillRows = sys.maxsize
+SpillDir = None
+Runs = []
+
+# With --binary the summary is written to a binary summary file instead of JSONL to stdout
+Writer = None
+
+# With --partitions the summary is written to partition files by hash of the aggregation key
+Partitions = []
+
+# With --rollup the table is kept per full host and month and the summary is written at several
+# aggregation levels to their own files instead of stdout
+Rollups = []
+ROLLUP_HOSTS = ['fullhost', 'lvl2', 'publicsuffix', 'tld']
+ROLLUP_DATES = ['monthly', 'yearly']
 
 def print_to_stderr(*a): 
 	print(*a, file = sys.stderr)
@@ -21,48 +57,223 @@ def print_to_stderr(*a):
 def summarize_line(info):
 	if not 'agg' in info:
 		return
-	agg = info['agg']
-	if not agg in Hosts:
-		Hosts[agg] = {}
-	date = info['date']
-	if not date in Hosts[agg]:
-		Hosts[agg][date] = mime_counter.init_counter()
 	if not 'mime' in info:
 		info['mime']='unknown'
-	mime_counter.add_mime(Hosts[agg][date], info["mime"], 1, info["length"])
-	mime_counter.add_scheme(Hosts[agg][date], info['scheme'], 1, info["length"])
+	Hosts.add_record(info['agg'], info['date'], info['mime'], info['scheme'], info['length'])
 
-def output_results(args):
-	dict_items = Hosts.items()
-	sorted_items = sorted(dict_items)
-	for lvl2, value in sorted_items:
-		out = {}
-		for year in value:
-			if args.compact:
-				tmp = mime_counter.as_dict(value[year])
-				out[year] = {}
-				for k in tmp:
-					if tmp[k] > 0:
-						out[year][k] = tmp[k]
+# same as summarize_line for a record returned by CdxParser.parse()
+def summarize_record(rec):
+	if rec is None:
+		return
+	Hosts.add_record(rec[CdxParser.R_AGG], rec[CdxParser.R_DATE], rec[CdxParser.R_MIME], rec[CdxParser.R_SCHEME], rec[CdxParser.R_LENGTH])
+	if Hosts.nrows >= SpillRows:
+		check_memory()
+
+# count a batch of records returned by CdxParser.parse_many(), the records of the same cell,
+# mime type and scheme are added up before the table is updated. This pays off for sorted input
+# where most records of a batch share their host, for unsorted input the records are counted one
+# by one and adding up is tried again every AGGREGATE_RETRY batches. The cells are created in the
+# order of the records, as with summarize_record
+def summarize_records(recs):
+	global AggregateBatches, Batches
+	Batches += 1
+	if AggregateBatches or Batches % AGGREGATE_RETRY == 0:
+		counts = {}
+		for rec in recs:
+			k = rec[0:4]
+			c = counts.get(k)
+			if c is None:
+				counts[k] = [1, rec[CdxParser.R_LENGTH]]
 			else:
-				out[year] = mime_counter.as_dict(value[year])
-		print(lvl2, json.dumps(out))
+				c[0] += 1
+				c[1] += rec[CdxParser.R_LENGTH]
+		AggregateBatches = 2 * len(counts) <= len(recs)
+		add_records = Hosts.add_records
+		for (date, agg, scheme, mime), (n, size) in counts.items():
+			add_records(agg, date, mime, scheme, n, size)
+	else:
+		add_record = Hosts.add_record
+		for date, agg, scheme, mime, length in recs:
+			add_record(agg, date, mime, scheme, length)
+	if Hosts.nrows >= SpillRows:
+		check_memory()
+
+# parse and count a batch of lines (without --assume_unique), if the batch can not be parsed
+# the lines are parsed one by one to report the line with the error
+def summarize_lines(parser, lines, filename):
+	try:
+		recs = parser.parse_many(lines)
+	except Exception:
+		recs = []
+		for line in lines:
+			try:
+				rec = parser.parse(line)
+				if rec is not None:
+					recs.append(rec)
+			except Exception as inst:
+				print_to_stderr("Unexpected error:", filename, inst, line)
+	summarize_records(recs)
+
+# the JSON part of an output line from the list of (date, counter)
+def dates_as_dict(dates, compact):
+	out = {}
+	for year, counter in dates:
+		if compact:
+			tmp = mime_counter.as_dict(counter)
+			out[year] = {}
+			for k in tmp:
+				if tmp[k] > 0:
+					out[year][k] = tmp[k]
+		else:
+			out[year] = mime_counter.as_dict(counter)
+	return out
 
-# output only the values for the key agg_by (aggregate_by) and then delete that key from the dictionary
-def output_partial_results(args, agg_by):
+# output the list of (date, counter) of an aggregation key
+def output_entry(args, agg, dates, out=None):
+	if out is None and Rollups:
+		for rollup in Rollups:
+			rollup.add(args, agg, dates)
+	elif out is None and Writer is not None:
+		Writer.add(agg, dates)
+	else:
+		print(agg, json.dumps(dates_as_dict(dates, args.compact)), file=out if out is not None else output_file(agg))
+
+# the output file of an aggregation key: stdout or its partition file
+def output_file(agg):
+	if Partitions:
+		return Partitions[summary_file.partition_of(agg, len(Partitions))]
+	return sys.stdout
+
+def output_results(args):
+	for lvl2 in sorted(Hosts.hosts()):
+		output_entry(args, lvl2, Hosts.dates(lvl2))
+
+# output only the values for the key agg_by (aggregate_by) and then delete that key from the table
+def output_partial_results(args, agg_by, out=None):
 	if agg_by in Hosts:
-		out = {}
-		for year in Hosts[agg_by]:
-			if args.compact:
-				tmp = mime_counter.as_dict(Hosts[agg_by][year])
-				out[year] = {}
-				for k in tmp:
-					if tmp[k] > 0:
-						out[year][k] = tmp[k]
+		output_entry(args, agg_by, Hosts.pop(agg_by), out)
+
+def init_spill(args):
+	global MaxMemory, SpillRows, SpillDir, Runs
+	Runs = []
+	if args.max_memory and not args.assume_unique:
+		MaxMemory = args.max_memory * 1024 * 1024
+		SpillRows = host_table.CHUNK_ROWS
+		SpillDir = args.tmpdir
+
+# the memory used is checked each time the table has grown by a chunk
+def check_memory():
+	global SpillRows
+	if Hosts.memory_usage() > MaxMemory:
+		spill_table()
+		SpillRows = host_table.CHUNK_ROWS
+	else:
+		SpillRows = Hosts.nrows + host_table.CHUNK_ROWS
+
+# write the table sorted by aggregation key to a run file and start with an empty table
+def spill_table():
+	global Hosts
+	if len(Hosts) == 0:
+		return
+	with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.run', dir=SpillDir, delete=False) as out:
+		for agg in sorted(Hosts.hosts()):
+			print(agg, json.dumps(dates_as_dict(Hosts.dates(agg), True)), file=out)
+	Runs.append(out.name)
+	Hosts = host_table.HostTable()
+
+def read_run(filename, i):
+	with open(filename, 'r', encoding='utf-8') as fil:
+		for line in fil:
+			p = line.find(' ')
+			yield line[0:p], i, line[p+1:]
+
+# k-way merge of the sorted runs, the entries of an aggregation key are added in the order of
+# the runs so that the dates are in the same order as without spilling
+def output_merged_runs(args):
+	spill_table()
+	lastagg = None
+	dates = {}
+	for agg, i, data in heapq.merge(*[read_run(f, i) for i, f in enumerate(Runs)]):
+		if agg != lastagg:
+			if lastagg is not None:
+				output_entry(args, lastagg, dates.items())
+			lastagg = agg
+			dates = {}
+		for date, values in json.loads(data).items():
+			varr = mime_counter.from_dict(values)
+			if date in dates:
+				mime_counter.add_counter(dates[date], varr)
 			else:
-				out[year] = mime_counter.as_dict(Hosts[agg_by][year])
-		print(agg_by, json.dumps(out))
-		del Hosts[agg_by]
+				dates[date] = varr
+	if lastagg is not None:
+		output_entry(args, lastagg, dates.items())
+	for f in Runs:
+		os.remove(f)
+
+# copy the entries already output by a worker (--assume_unique), entries that are
+# still in Hosts (left over at the end of a previous file) are added before output
+def copy_partial_results(args, filename):
+	with open(filename, 'r', encoding='utf-8') as fil:
+		for line in fil:
+			p = line.find(' ')
+			agg = line[0:p]
+			if agg in Hosts:
+				for date, values in json.loads(line[p+1:]).items():
+					Hosts.add_counter(agg, int(date), mime_counter.from_dict(values))
+				output_partial_results(args, agg)
+			elif Writer is not None:
+				Writer.add(agg, [(date, mime_counter.from_dict(values)) for date, values in json.loads(line[p+1:]).items()])
+			else:
+				output_file(agg).write(line)
+	os.remove(filename)
+
+# ----- Rollups (--rollup HOSTS/DATES:FILE)
+# The entries of the table (full host, month) are added up per aggregation key of the rollup and
+# per year or month. The rollup per full host and month is written as the entries come, the
+# others are kept in their own (much smaller) table until write() is called
+class Rollup:
+	def __init__(self, hosts, dates, filename):
+		self.hosts = hosts
+		self.yearly = dates == 'yearly'
+		self.filename = filename
+		self.out = open(filename, 'w', encoding='utf-8')
+		self.table = None if hosts == 'fullhost' and not self.yearly else host_table.HostTable()
+
+	# the aggregation key of a full host, the last two labels for lvl2 as CdxParser.lvl2_from_host
+	def key(self, host):
+		if self.hosts == 'lvl2':
+			p = host.rfind('.')
+			if p > -1:
+				return host[host.rfind('.', 0, p - 1) + 1:]
+		elif self.hosts == 'tld':
+			return host[host.rfind('.') + 1:]
+		elif self.hosts == 'publicsuffix':
+			return CdxParser.private_suffix(host)
+		return host
+
+	# add the list of (date, counter) of a full host, the dates are YYYYMM (int or str)
+	def add(self, args, host, dates):
+		if self.table is None:
+			output_entry(args, host, dates, self.out)
+			return
+		key = self.key(host)
+		for date, counter in dates:
+			date = int(date)
+			self.table.add_counter(key, date // 100 if self.yearly else date, counter)
+
+	def write(self, args):
+		if self.table is not None:
+			for agg in sorted(self.table.hosts()):
+				output_entry(args, agg, self.table.dates(agg), self.out)
+		self.out.close()
+
+# a rollup of --rollup: (hosts, dates, filename)
+def rollup_arg(s):
+	level, sep, filename = s.partition(':')
+	hosts, sep2, dates = level.partition('/')
+	if not sep or not sep2 or not filename or not hosts in ROLLUP_HOSTS or not dates in ROLLUP_DATES:
+		raise ValueError(s)
+	return (hosts, dates, filename)
 
 def determine_cdx_type(line):
 	tokens = line.split()
@@ -71,6 +282,8 @@ def determine_cdx_type(line):
 	if len(tokens)>=6:
 		if line.strip() == 'CDX N b a m s k r M S V g':
 			return CdxParser.FORMAT_CDXNbamskrMSVg
+		if line.strip() == 'CDX N b a m s S':
+			return CdxParser.FORMAT_CDXNbamsS
 		if tokens[0]=='CDX':
 			if line[0:14] == ' CDX N b a m s':
 				return CdxParser.FORMAT_CDXNbams
@@ -97,10 +310,28 @@ def cdx_type_from_args(args):
 		return CdxParser.FORMAT_CDXNbams
 	elif args.format=='cdxNbamskrMSVg':
 		return CdxParser.FORMAT_CDXNbamskrMSVg
+	elif args.format=='cdxNbamsS':
+		return CdxParser.FORMAT_CDXNbamsS
 	else:
 		return CdxParser.FORMAT_UNKNOWN
 
-def read_cdx_file(args, fil, filename):
+# returns the CdxParser.LineFilter of the --key_from, --key_to, --surt_prefix, --tld, --from_date
+# and --to_date options for the format or None if there are none
+def line_filter(args, ftype, filename=None):
+	if args.key_ranges is None and not args.from_date and not args.to_date:
+		return None
+	if ftype == CdxParser.FORMAT_CDXNbams:
+		# the keys are not SURTs, only the TLDs can be checked (warned once per file, rejected with --format cdxNbams)
+		if filename is not None and (args.surt_prefix or args.key_from or args.key_to):
+			print_to_stderr('WARNING: incompatible arguments: --surt_prefix, --key_from and --key_to and the cdxNbams format, they are ignored for', filename)
+		return CdxParser.LineFilter(None, args.from_date, args.to_date, args.tld)
+	return CdxParser.LineFilter(args.key_ranges, args.from_date, args.to_date)
+
+# stop reading at the first line after the key ranges
+def stop_at_past(args):
+	return args.assume_sorted or args.zipnum
+
+def read_cdx_file(args, fil, filename, out=None):
 	line = fil.readline()
 	ftype = cdx_type_from_args(args)
 	if ftype == CdxParser.FORMAT_UNKNOWN:
@@ -108,39 +339,488 @@ def read_cdx_file(args, fil, filename):
 	if ftype == CdxParser.FORMAT_UNKNOWN:
 		print_to_stderr("Unsupported cdx format: ", filename, line)
 		return
-	parser = CdxParser.CdxParser(ftype, args.monthly, args.fullhost)
+	parser = CdxParser.CdxParser(ftype, args.monthly, args.fullhost, args.publicsuffix)
+	filt = line_filter(args, ftype, filename)
+	stop = stop_at_past(args)
 	aggregate_by = ''
-	res = parser.parse_line(line)
-	if 'agg' in res:
-		aggregate_by = res['agg']
-		summarize_line(res)
+	rec = parser.parse(line) if filt is None or filt.check(line) == CdxParser.F_ACCEPT else None
+	if rec is not None:
+		aggregate_by = rec[CdxParser.R_AGG]
+		summarize_record(rec)
+	batch = None if args.assume_unique else []
 	for line in fil:
 		try:
-			res = parser.parse_line(line)
-			summarize_line(res)
+			if filt is not None:
+				c = filt.check(line)
+				if c != CdxParser.F_ACCEPT:
+					if c == CdxParser.F_PAST and stop:
+						break
+					continue
+			if batch is not None:
+				batch.append(line)
+				if len(batch) == BATCH_LINES:
+					summarize_lines(parser, batch, filename)
+					batch = []
+				continue
+			rec = parser.parse(line)
+			summarize_record(rec)
 			if args.assume_unique:
-				if 'agg' in res and res['agg'] != aggregate_by:
-					output_partial_results(args, aggregate_by)
-					aggregate_by = res['agg']
+				if rec is not None and rec[CdxParser.R_AGG] != aggregate_by:
+					output_partial_results(args, aggregate_by, out)
+					aggregate_by = rec[CdxParser.R_AGG]
 		except Exception as inst:
 			print_to_stderr("Unexpected error:", filename, inst, line)
+	if batch:
+		summarize_lines(parser, batch, filename)
 
-def dowork(args):
-	for f in args.file:
-		if (args.gz or (len(f) > 3 and f[-3:] == '.gz')) and (not args.nogz):
-			try:
-				with gzip.open(f, mode='rt', encoding=args.encoding) as z:
-					read_cdx_file(args, z, f)
-			except Exception as inst:
-				print_to_stderr("Error", inst, f)
+def is_gz(args, f):
+	return (args.gz or (len(f) > 3 and f[-3:] == '.gz')) and (not args.nogz)
+
+def summarize_file(args, f, out=None):
+	if args.reader_thread:
+		try:
+			with line_reader.ThreadedLineReader(f, args.encoding, is_gz(args, f), line_reader.command_of(args.decompressor)) as fil:
+				read_cdx_file(args, fil, f, out)
+		except Exception as inst:
+			print_to_stderr("Error", inst, f)
+	elif is_gz(args, f):
+		try:
+			with gzip.open(f, mode='rt', encoding=args.encoding) as z:
+				read_cdx_file(args, z, f, out)
+		except Exception as inst:
+			print_to_stderr("Error", inst, f)
+	else:
+		try:
+			with open(f, 'r', encoding=args.encoding) as fil:
+				read_cdx_file(args, fil, f, out)
+		except Exception as inst:
+			print_to_stderr("Error (dowork)", inst, f)
+
+# the lines starting in the byte range [start, end[ of an uncompressed file
+def range_lines(filename, start, end):
+	with open(filename, 'rb') as fil:
+		if start > 0:
+			fil.seek(start - 1)
+			pos = start - 1 + len(fil.readline())
+		else:
+			pos = 0
+		while pos < end:
+			bline = fil.readline()
+			if bline == b'':
+				break
+			pos += len(bline)
+			yield bline
+
+# the lines of the gzip members in the byte range [start, end[ of a multi-member gzip file
+# the range ends with a complete line (see gzip_members.MemberIndex.ranges)
+def member_lines(filename, start, end):
+	with open(filename, 'rb') as fil:
+		fil.seek(start)
+		data = fil.read(end - start)
+	with gzip.GzipFile(fileobj=io.BytesIO(data)) as z:
+		yield from z
+
+# summarize the lines starting in the byte range [start, end[ of an uncompressed file, or the
+# lines of the members in the range of a multi-member gzip file (or ZipNum shard)
+# a line belongs to the range in which it starts. For the first range (or with first) this behaves
+# like read_cdx_file, for the other ranges the run of the first aggregation key is not output
+# (it might have started in the previous range) but returned as head
+# returns the first aggregation key, the head and the aggregation key of the last run
+def read_cdx_range(args, filename, ftype, start, end, out=None, first=None, last_agg=''):
+	parser = CdxParser.CdxParser(ftype, args.monthly, args.fullhost, args.publicsuffix)
+	filt = line_filter(args, ftype, filename if start == 0 else None)
+	stop = stop_at_past(args)
+	first_agg = None
+	head = None
+	# the shards of a ZipNum cluster are one sorted file, only its first range is first (as summarize_zipnum)
+	if first is None:
+		first = start == 0 and not args.zipnum
+	# with first, the range continues the run of last_agg (the last host of the previous range, still in Hosts)
+	if first:
+		aggregate_by = last_agg
+	else:
+		aggregate_by = None
+	if args.zipnum or is_gz(args, filename):
+		lines = member_lines(filename, start, end)
+	else:
+		lines = range_lines(filename, start, end)
+	batch = None if args.assume_unique else []
+	for bline in lines:
+		line = ''
+		try:
+			line = bline.decode(args.encoding)
+			if filt is not None:
+				c = filt.check(line)
+				if c != CdxParser.F_ACCEPT:
+					if c == CdxParser.F_PAST and stop:
+						break
+					continue
+			if batch is not None:
+				batch.append(line)
+				if len(batch) == BATCH_LINES:
+					summarize_lines(parser, batch, filename)
+					batch = []
+				continue
+			rec = parser.parse(line)
+			summarize_record(rec)
+			if args.assume_unique and rec is not None:
+				if aggregate_by is None:
+					first_agg = rec[CdxParser.R_AGG]
+					aggregate_by = first_agg
+				elif rec[CdxParser.R_AGG] != aggregate_by:
+					if not first and head is None:
+						head = (aggregate_by, Hosts.pop(aggregate_by))
+					else:
+						output_partial_results(args, aggregate_by, out)
+					aggregate_by = rec[CdxParser.R_AGG]
+		except Exception as inst:
+			print_to_stderr("Unexpected error:", filename, inst, line)
+	if batch:
+		summarize_lines(parser, batch, filename)
+	return first_agg, head, aggregate_by
+
+# runs in a worker process: summarize a single file or a byte range of a file into a fresh table and return it
+# with --assume_unique the finished entries are written to a temporary file instead of stdout
+def summarize_file_worker(task):
+	global Hosts
+	args, f, ftype, start, end = task
+	Hosts = host_table.HostTable()
+	init_spill(args)
+	tmpname = None
+	edges = (None, None, None)
+	stats = mime_counter.cache_stats()
+	out = None
+	if args.assume_unique:
+		out = tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.summary', delete=False)
+		tmpname = out.name
+	try:
+		if end is None:
+			summarize_file(args, f, out)
 		else:
+			edges = read_cdx_range(args, f, ftype, start, end, out)
+	except Exception as inst:
+		print_to_stderr("Error (worker)", inst, f)
+	if out:
+		out.close()
+	# media type cache statistics of this task only, the worker process is reused
+	stats = [b - a for a, b in zip(stats, mime_counter.cache_stats())]
+	return Hosts, Runs, tmpname, edges, stats
+
+# returns the format of a cdx file from its first line or the format given in the arguments
+def file_cdx_type(args, f, line):
+	ftype = cdx_type_from_args(args)
+	if ftype == CdxParser.FORMAT_UNKNOWN:
+		ftype = determine_cdx_type(line)
+	if ftype == CdxParser.FORMAT_UNKNOWN:
+		print_to_stderr("Unsupported cdx format: ", f, line)
+	return ftype
+
+# gzip files made of several members are split into groups of members when their member index
+# is known (saved by gzip_members.py or found with --scan_members), other gzip files are read whole
+def gz_file_tasks(args, f):
+	try:
+		index = gzip_members.member_index(f, args.scan_members)
+	except Exception as inst:
+		print_to_stderr("No member index", inst, f)
+		index = None
+	ranges = index.ranges(args.chunk_size) if index is not None else []
+	if len(ranges) < 2:
+		return [(args, f, CdxParser.FORMAT_UNKNOWN, 0, None)]
+	try:
+		with gzip.open(f, mode='rt', encoding=args.encoding) as z:
+			line = z.readline()
+	except Exception as inst:
+		print_to_stderr("Error", inst, f)
+		return []
+	ftype = file_cdx_type(args, f, line)
+	if ftype == CdxParser.FORMAT_UNKNOWN:
+		return []
+	return [(args, f, ftype, start, end) for start, end in ranges]
+
+# the blocks of a ZipNum cluster in the key range are read in runs of consecutive blocks of about
+# --chunk_size uncompressed bytes, the format of each shard is determined from the first line read
+def zipnum_tasks(args, f):
+	try:
+		blocks = zipnum.read_idx(f)
+		paths = zipnum.shard_paths(f, blocks, args.zipnum_loc)
+	except Exception as inst:
+		print_to_stderr("Error", inst, f)
+		return []
+	blocks = zipnum.select_blocks(blocks, args.key_ranges)
+	tasks = []
+	ftypes = {}
+	for path, start, end in zipnum.block_ranges(blocks, paths, args.chunk_size // zipnum.COMPRESSION_RATIO):
+		if not path in ftypes:
 			try:
-				with open(f, 'r', encoding=args.encoding) as fil:
-					read_cdx_file(args, fil, f)
+				with open(path, 'rb') as fil:
+					fil.seek(start)
+					with gzip.GzipFile(fileobj=fil) as z:
+						ftypes[path] = file_cdx_type(args, path, z.readline().decode(args.encoding))
 			except Exception as inst:
-				print_to_stderr("Error (dowork)", inst, f)
-	output_results(args)
+				print_to_stderr("Error", inst, path)
+				ftypes[path] = CdxParser.FORMAT_UNKNOWN
+		if ftypes[path] != CdxParser.FORMAT_UNKNOWN:
+			tasks.append((args, path, ftypes[path], start, end))
+	return tasks
+
+# without --workers, the runs of blocks are read one after the other like a single file, with
+# --assume_unique the last host of a run of blocks is carried over to the next one
+def summarize_zipnum(args, f):
+	aggregate_by = ''
+	for task in zipnum_tasks(args, f):
+		try:
+			aggregate_by = read_cdx_range(args, task[1], task[2], task[3], task[4], first=True, last_agg=aggregate_by)[2]
+		except Exception as inst:
+			print_to_stderr("Error", inst, task[1])
+
+# big uncompressed files are split into ranges, the format is determined once from the first line
+def file_tasks(args, f):
+	if args.zipnum:
+		return zipnum_tasks(args, f)
+	if args.workers > 1 and is_gz(args, f):
+		return gz_file_tasks(args, f)
+	if args.workers > 1:
+		try:
+			size = os.path.getsize(f)
+			if size > args.chunk_size:
+				with open(f, 'r', encoding=args.encoding) as fil:
+					line = fil.readline()
+				ftype = file_cdx_type(args, f, line)
+				if ftype == CdxParser.FORMAT_UNKNOWN:
+					return []
+				nchunks = (size + args.chunk_size - 1) // args.chunk_size
+				step = (size + nchunks - 1) // nchunks
+				return [(args, f, ftype, start, min(start + step, size)) for start in range(0, size, step)]
+		except Exception as inst:
+			print_to_stderr("Error (dowork)", inst, f)
+			return []
+	return [(args, f, CdxParser.FORMAT_UNKNOWN, 0, None)]
+
+def dowork_parallel(args):
+	tasks = []
+	for f in args.file:
+		tasks.extend(file_tasks(args, f))
+	aggregate_by = ''
+	stats = [0, 0]
+	with multiprocessing.Pool(args.workers) as pool:
+		# results are merged in the order of the files, so that the output is the same as for a serial run
+		for partial, runs, tmpname, edges, task_stats in pool.imap(summarize_file_worker, tasks):
+			stats[0] += task_stats[0]
+			stats[1] += task_stats[1]
+			first_agg, head, last_agg = edges
+			# stitch the run that crosses the start of the range to the end of the previous range
+			if first_agg is not None:
+				if first_agg != aggregate_by:
+					output_partial_results(args, aggregate_by)
+				if head is not None:
+					for date, counter in head[1]:
+						Hosts.add_counter(head[0], date, counter)
+					output_partial_results(args, head[0])
+			if tmpname:
+				copy_partial_results(args, tmpname)
+			if runs:
+				# the runs of the task come after what is already in the table
+				spill_table()
+				Runs.extend(runs)
+			Hosts.merge(partial)
+			if MaxMemory and Hosts.memory_usage() > MaxMemory:
+				spill_table()
+			if last_agg is not None:
+				aggregate_by = last_agg
+	return stats
+
+# ----- Incremental mode (--update SUMMARY)
+# The manifest (SUMMARY.manifest) lists the cdx files already in SUMMARY with their size, modification
+# time (and SHA-1 with --hash). Only the new or changed files are summarized. The table of each file is
+# kept as a partial summary in SUMMARY.parts, so that the counts of a file that has changed can be
+# subtracted before its new counts are added. The size and modification time of SUMMARY are in the
+# manifest too, an update that was interrupted before the manifest was written is detected.
+def manifest_filename(args):
+	return args.manifest if args.manifest else args.update + '.manifest'
+
+def parts_dirname(args):
+	return args.update + '.parts'
+
+def file_sha1(f):
+	h = hashlib.sha1()
+	with open(f, 'rb') as fil:
+		for block in iter(lambda: fil.read(1024 * 1024), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def stat_entry(f):
+	st = os.stat(f)
+	return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def load_manifest(args):
+	options = {'monthly': args.monthly, 'fullhost': args.fullhost}
+	if args.publicsuffix:
+		options['publicsuffix'] = True
+	# the summary of a part of the captures only
+	if args.key_ranges is not None or args.from_date or args.to_date:
+		options['filter'] = {'key_ranges': [list(r) for r in args.key_ranges] if args.key_ranges else None, 'from_date': args.from_date, 'to_date': args.to_date}
+	filename = manifest_filename(args)
+	if not os.path.exists(filename):
+		if os.path.exists(args.update):
+			print_to_stderr("No manifest", filename + ", the files in", args.update, "so far are kept as they are")
+		return {'options': options, 'generation': 0, 'summary': None, 'files': {}}
+	with open(filename, 'r', encoding='utf-8') as fil:
+		manifest = json.load(fil)
+	if manifest['options'] != options:
+		raise ValueError('%s was made with the options %s' % (args.update, json.dumps(manifest['options'])))
+	if manifest['summary'] != (stat_entry(args.update) if os.path.exists(args.update) else None):
+		raise ValueError('%s has changed since %s was written (interrupted update?), summarize all the files again' % (args.update, filename))
+	return manifest
+
+def save_manifest(args, manifest):
+	filename = manifest_filename(args)
+	with open(filename + '.tmp', 'w', encoding='utf-8') as out:
+		json.dump(manifest, out, indent=1)
+	os.replace(filename + '.tmp', filename)
+
+# returns the entry of the manifest for f if it has to be summarized, None if it is unchanged
+def changed_entry(args, f, old):
+	entry = stat_entry(f)
+	if old is not None and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns']:
+		return None
+	if args.hash:
+		entry['sha1'] = file_sha1(f)
+		# only the modification time has changed
+		if old is not None and old.get('sha1') == entry['sha1']:
+			old['mtime_ns'] = entry['mtime_ns']
+			return None
+	return entry
+
+# the table of each file in its own process with --workers
+def file_tables(args, files):
+	global Hosts
+	if args.workers > 1:
+		with multiprocessing.Pool(args.workers) as pool:
+			for f, result in zip(files, pool.imap(summarize_file_worker, [(args, f, CdxParser.FORMAT_UNKNOWN, 0, None) for f in files])):
+				yield f, result[0]
+	else:
+		for f in files:
+			Hosts = host_table.HostTable()
+			summarize_file(args, f)
+			yield f, Hosts
+
+def write_partial(filename, table):
+	with open(filename, 'w', encoding='utf-8') as out:
+		for agg in sorted(table.hosts()):
+			print(agg, json.dumps(dates_as_dict(table.dates(agg), True)), file=out)
+
+# add (sign 1) or subtract (sign -1) a summary file to the table
+def add_summary(table, filename, sign=1):
+	for agg, dates in summary_file.read_summary(filename):
+		for date, counter in dates:
+			table.add_counter(agg, int(date), counter if sign > 0 else [-v for v in counter])
+
+def dowork_incremental(args):
+	global Hosts, Writer
+	try:
+		manifest = load_manifest(args)
+	except Exception as inst:
+		print_to_stderr("Error", inst, manifest_filename(args))
+		return
+	todo = []
+	for f in args.file:
+		key = os.path.abspath(f)
+		try:
+			entry = changed_entry(args, f, manifest['files'].get(key))
+		except Exception as inst:
+			print_to_stderr("Error", inst, f)
+			continue
+		if entry is not None:
+			todo.append((f, key, entry))
+	if not todo:
+		print_to_stderr("No new or changed files")
+		save_manifest(args, manifest)
+		return
+	total = host_table.HostTable()
+	if os.path.exists(args.update):
+		add_summary(total, args.update)
+	manifest['generation'] += 1
+	os.makedirs(parts_dirname(args), exist_ok=True)
+	old_parts = []
+	for (f, key, entry), (_, table) in zip(todo, file_tables(args, [t[0] for t in todo])):
+		old = manifest['files'].get(key)
+		if old is not None:
+			print_to_stderr("Changed:", f)
+			old_parts.append(os.path.join(parts_dirname(args), old['partial']))
+			add_summary(total, old_parts[-1], -1)
+		entry['partial'] = hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16] + '-' + str(manifest['generation']) + '.summary'
+		write_partial(os.path.join(parts_dirname(args), entry['partial']), table)
+		total.merge(table)
+		manifest['files'][key] = entry
+	# the new summary replaces the old one, in the same format
+	Hosts = total
+	tmpname = args.update + '.tmp'
+	out = None
+	if os.path.exists(args.update) and summary_file.is_binary(args.update):
+		Writer = summary_file.SummaryWriter(tmpname)
+	else:
+		out = open(tmpname, 'w', encoding='utf-8')
+	for agg in sorted(Hosts.hosts()):
+		# cells that were only in the subtracted files are all 0
+		dates = [(date, counter) for date, counter in Hosts.dates(agg) if any(counter)]
+		if dates:
+			output_entry(args, agg, dates, out)
+	if out is not None:
+		out.close()
+	else:
+		Writer.close()
+		Writer = None
+	os.replace(tmpname, args.update)
+	manifest['summary'] = stat_entry(args.update)
+	save_manifest(args, manifest)
+	for f in old_parts:
+		os.remove(f)
+	print_to_stderr(len(todo), "files added to", args.update)
+
+def print_stats(hits, misses):
+	total = hits + misses
+	print_to_stderr('media type cache: %d lookups, %d hits, %d misses, hit rate %.2f%%' % (total, hits, misses, 100.0 * hits / total if total else 0.0))
+
+def dowork(args):
+	global Writer, Partitions
+	if args.update:
+		dowork_incremental(args)
+		return
+	init_spill(args)
+	if args.binary:
+		Writer = summary_file.SummaryWriter(args.binary)
+	if args.partitions:
+		Partitions = summary_file.open_partitions(args.partition_prefix, args.partitions)
+	for hosts, dates, filename in args.rollup or []:
+		Rollups.append(Rollup(hosts, dates, filename))
+	if args.workers > 1:
+		hits, misses = dowork_parallel(args)
+	else:
+		for f in args.file:
+			if args.zipnum:
+				summarize_zipnum(args, f)
+			else:
+				summarize_file(args, f)
+		hits, misses, size = mime_counter.cache_stats()
+	if Runs:
+		output_merged_runs(args)
+	else:
+		output_results(args)
+	for rollup in Rollups:
+		rollup.write(args)
+	if Writer is not None:
+		Writer.close()
+	for out in Partitions:
+		out.close()
+	if args.stats:
+		print_stats(hits, misses)
+
 
+# a date of --from_date and --to_date: the start of a timestamp
+def date_arg(s):
+	if not s.isdecimal() or len(s) < 4 or len(s) > 14:
+		raise ValueError(s)
+	return s
 
 if __name__ == '__main__':
 	parser = ArgumentParser(description='Summarize CDX file(s) to JSONL, automatically uses gzip filter if file ends with .gz')
@@ -149,9 +829,58 @@ if __name__ == '__main__':
 	parser.add_argument('--monthly', action="store_true", help='break up statistics into monthly buckets instead of yearly')
 	parser.add_argument('--compact', action="store_true", help='do not output fields that are 0')
 	parser.add_argument('--fullhost', action="store_true", default=False, help='aggregate by full hostname instead of second level domain')
+	parser.add_argument('--publicsuffix', action="store_true", default=False, help='aggregate by registrable domain (public suffix + 1, e.g. example.co.uk) instead of second level domain, needs the publicsuffixlist module')
 	parser.add_argument('--assume_unique', action="store_true", default=False, help='assume aggregation entry only appears in a continous run in the CDX file(s) (OK for single, sorted CDX with --fullhost)')
-	parser.add_argument('--format',choices=['cdxj','cdx7','cdxNbams', 'cdxNbamskrMSVg'], help='force use of cdx format (cdxNbams = N b a m s)')
+	parser.add_argument('--format',choices=['cdxj','cdx7','cdxNbams', 'cdxNbamskrMSVg', 'cdxNbamsS'], help='force use of cdx format (cdxNbams = N b a m s)')
 	parser.add_argument('--encoding', action="store", default='utf-8', help='encoding, e.g. iso-8859-1 (default is your locale\'s defaut encoding, probably utf-8 on Linux). All CDX files have to have the same encoding')
+	parser.add_argument('--workers', type=int, default=1, help='number of worker processes, each cdx file is summarized in its own process (default 1)')
+	parser.add_argument('--chunk_size', type=int, default=64*1024*1024, help='with --workers, split uncompressed cdx files bigger than this many bytes into ranges summarized in parallel (default 64MB)')
+	parser.add_argument('--scan_members', action="store_true", help='with --workers, find the members of .gz files made of several gzip members that have no member index (see gzip_members.py) to summarize groups of members in parallel')
+	parser.add_argument('--max_memory', '--max-memory', type=int, default=0, help='write the table to sorted run files in a temporary directory when it uses more than this many MB and merge them at the end (per process, ignored with --assume_unique)')
+	parser.add_argument('--tmpdir', action="store", default=None, help='directory for the run files of --max_memory (default is the system\'s temporary directory)')
+	parser.add_argument('--binary', action="store", metavar='FILE', help='write the summary in the binary summary format to FILE (- for stdout) instead of JSONL to stdout')
+	parser.add_argument('--reader_thread', '--reader-thread', action="store_true", help='read and decompress the cdx files in a separate thread while they are parsed')
+	parser.add_argument('--decompressor', choices=['python', 'pigz', 'zcat', 'auto'], default='python', help='with --reader_thread, decompress .gz files with python\'s gzip module or an external pigz or zcat process (auto: pigz or zcat if available, default python)')
+	parser.add_argument('--stats', action="store_true", help='print the hit rate of the media type cache to stderr')
+	parser.add_argument('--zipnum', action="store_true", help='the files are the secondary indexes (.idx) of ZipNum clusters, only the blocks of the shards in the key range are read')
+	parser.add_argument('--zipnum_loc', action="store", metavar='FILE', help='location file of the ZipNum shards (default: the .loc file next to the .idx file if there is one, else SHARD.gz in the directory of the .idx file)')
+	parser.add_argument('--key_from', action="store", metavar='KEY', help='only summarize the lines whose SURT key is at least KEY')
+	parser.add_argument('--key_to', action="store", metavar='KEY', help='only summarize the lines whose SURT key is before KEY')
+	parser.add_argument('--surt_prefix', '--surt-prefix', action="store", metavar='PREFIX', help='only summarize the lines whose SURT key starts with PREFIX, e.g. "lu,"')
+	parser.add_argument('--tld', action="append", metavar='TLD', help='only summarize the lines of hosts in the top level domain (or domain suffix) TLD, e.g. "lu" or "co.uk" (can be given several times)')
+	parser.add_argument('--from_date', '--from-date', type=date_arg, metavar='DATE', help='only summarize the captures from DATE on (YYYY, YYYYMM or YYYYMMDD...)')
+	parser.add_argument('--to_date', '--to-date', type=date_arg, metavar='DATE', help='only summarize the captures until DATE included (YYYY, YYYYMM or YYYYMMDD...)')
+	parser.add_argument('--assume_sorted', action="store_true", default=False, help='assume the cdx files are sorted, stop reading a file after the key range of --key_from, --key_to, --surt_prefix and --tld (always done with --zipnum)')
+	parser.add_argument('--rollup', action="append", type=rollup_arg, metavar='HOSTS/DATES:FILE', help='count per full host and month and write the summary per HOSTS (' + ', '.join(ROLLUP_HOSTS) + ') and DATES (' + ', '.join(ROLLUP_DATES) + ') to FILE instead of stdout, e.g. lvl2/yearly:lvl2.summary (can be given several times, --monthly, --fullhost, --publicsuffix and --assume_unique are ignored)')
+	parser.add_argument('--partitions', type=int, default=0, metavar='N', help='write the summary to N sorted partition files PREFIX-I-of-N.summary by hash of the aggregation key instead of stdout')
+	parser.add_argument('--partition_prefix', action="store", default='part', metavar='PREFIX', help='prefix of the partition files (default part)')
+	parser.add_argument('--update', action="store", metavar='SUMMARY', help='add the new or changed cdx files to the summary file SUMMARY (created if needed) instead of writing to stdout, the files already summarized are listed in a manifest (--assume_unique and --max_memory are ignored)')
+	parser.add_argument('--manifest', action="store", metavar='FILE', help='manifest of --update (default SUMMARY.manifest)')
+	parser.add_argument('--hash', action="store_true", help='with --update, also compare the SHA-1 of the files whose modification time has changed')
 	parser.add_argument('file', nargs='*', help='cdx file (can be several)')
 	args = parser.parse_args()
+	if args.update and args.binary:
+		parser.error('--update writes to SUMMARY in its format, --binary can not be used with it')
+	if args.zipnum and args.update:
+		parser.error('--update can not be used with --zipnum')
+	if args.partitions and (args.update or args.binary or args.rollup):
+		parser.error('--partitions writes JSONL partition files, --update, --binary and --rollup can not be used with it')
+	if args.rollup and (args.update or args.binary):
+		parser.error('--rollup writes the summaries to their files, --update and --binary can not be used with it')
+	if args.rollup:
+		args.monthly = True
+		args.fullhost = True
+		args.publicsuffix = False
+		args.assume_unique = False
+	if args.publicsuffix and args.fullhost:
+		parser.error('--publicsuffix and --fullhost can not be used together')
+	if args.format == 'cdxNbams' and (args.surt_prefix or args.key_from or args.key_to):
+		parser.error('the keys of cdxNbams files are not SURTs, --surt_prefix, --key_from and --key_to can not be used with --format cdxNbams')
+	if args.publicsuffix or any(r[0] == 'publicsuffix' for r in args.rollup or []):
+		# loaded once before the workers are started
+		CdxParser.public_suffix_list()
+	args.key_ranges = CdxParser.key_ranges(args.key_from, args.key_to, args.surt_prefix, args.tld)
+	if args.update:
+		args.assume_unique = False
+		args.max_memory = 0
 	dowork(args)
@@ -4,54 +4,56 @@ from argparse import ArgumentParser
 import sys
 import json
 import mime_counter
+import host_table
+import summary_file
 import operator
-from publicsuffixlist import PublicSuffixList
+import heapq
+import os
+import tempfile
+import multiprocessing
+import CdxParser
 
-Hosts = dict()
+Hosts = host_table.HostTable()
+# With --binary the result is written to a binary summary file
+Writer = None
+# With --partitions the result is written to partition files by hash of the host
+Partitions = []
 
 def print_to_stderr(*a):
     print(*a, file = sys.stderr)
 
-def simplifyhost(psl, args, host):
+def simplifyhost(args, host):
     if args.aggregatehosts == 'lvl2':
         p = host.rfind('.')
         if p > -1:
             p1 = host.rfind('.', 0, p -1)
             return host[p1+1:]
     elif args.aggregatehosts == 'publicsuffixlist':
-        retval = psl.privatesuffix(host)
-        if retval:
-            return retval
-        else:
-            return host
+        # cached, the hosts of the summary files are often repeated
+        return CdxParser.private_suffix(host)
     return host
 
-def addFile(args, filename, psl):
-    f = open(filename, 'r', errors="ignore")
-    for line in f:
-        p = line.find(" {\"")
-        host = line[0:p]
+# with partition = (i, n), only the hosts of the partition i of n are added
+def addFile(args, filename, partition=None):
+    accept = None
+    if partition is not None:
+        accept = lambda host: summary_file.partition_of(simplifyhost(args, host), partition[1]) == partition[0]
+    for host, entry in summary_file.read_summary(filename, accept):
         if args.aggregatehosts != 'none':
-            host = simplifyhost(psl, args, host)
-        entry = json.loads(line[p+1:])
-        if not host in Hosts:
-            Hosts[host] = dict()
-        for year, values in entry.items():
-            varr = mime_counter.from_dict(values)
+            host = simplifyhost(args, host)
+        Hosts.host_id(host)
+        for year, values in entry:
             if args.yearly:
                 year = year[0:4]
-            if year in Hosts[host]:
-                for i, vi in enumerate(varr):
-                    Hosts[host][year][i] += vi
-            else:
-                Hosts[host][year] = varr
+            Hosts.add_counter(host, year, values)
 
-def outputResults(args):
-    dict_items = Hosts.items()
-    sorted_items = sorted(dict_items)
-    for lvl2, entry in sorted_items:
+def outputResults(args, out=None):
+    for lvl2 in sorted(Hosts.hosts()):
+        if out is None and Writer is not None:
+            Writer.add(lvl2, Hosts.dates(lvl2))
+            continue
         r = {}
-        for year, values in entry.items():
+        for year, values in Hosts.dates(lvl2):
             if args.compact:
                 tmp = mime_counter.as_dict(values)
                 r[year] = {}
@@ -60,9 +62,12 @@ def outputResults(args):
                         r[year][k] = tmp[k]
             else:
                 r[year] = mime_counter.as_dict(values)
-        print(lvl2, json.dumps(r))
+        print(lvl2, json.dumps(r), file=out if out is not None else output_file(lvl2))
 
 def output_host(args, hostname, years):
+    if Writer is not None:
+        Writer.add(hostname, years.items())
+        return
     r = {}
     for year, values in years.items():
         if args.compact:
@@ -73,96 +78,155 @@ def output_host(args, hostname, years):
                     r[year][k] = tmp[k]
         else:
             r[year] = mime_counter.as_dict(values)
-    print(hostname, json.dumps(r))
+    print(hostname, json.dumps(r), file=output_file(hostname))
+
+# yields the (key, years) of sorted iterators of (host, years) in the order of the keys, an iterator
+# is only advanced when its key is the smallest. The iterators are kept in a heap ordered by
+# (key, tick), the tick makes the iterator that was advanced last come first among those with the
+# same key, as with the stable sort of the list of files used before
+def merge_entries(iterators, key):
+    heap = []
+    for i, it in enumerate(iterators):
+        entry = next(it, None)
+        if entry is not None:
+            heap.append((key(entry[0]), i, i, entry[1]))
+    heapq.heapify(heap)
+    tick = 0
+    while heap:
+        h, t, i, years = heap[0]
+        yield h, years
+        entry = next(iterators[i], None)
+        if entry is None:
+            heapq.heappop(heap)
+        else:
+            tick -= 1
+            heapq.heapreplace(heap, (key(entry[0]), tick, i, entry[1]))
 
 # assume input files are sorted by aggregation key (host)
-# open all files at once and then advance in each file only if its key is the smallest
+# open all files at once and merge them, the files are only parsed one entry at a time
 def read_sorted(args):
     agghost = False
     if args.aggregatehosts and args.aggregatehosts != 'none':
         agghost = True
         print_to_stderr('WARNING: incompatible arguments: --aggregatehosts', args.aggregatehosts,'and --assume_unique, this gives a non-sorted output')
-    fil = []
-    if args.aggregatehosts == 'publicsuffixlist':
-        psl = PublicSuffixList()
+    if agghost:
+        key = lambda host: simplifyhost(args, host)
     else:
-        psl = None
+        key = lambda host: host
     # open all files
-    nEOF = 0
-    for f in args.file:
-        obj = {'file':f, 'fp': open(f, 'r', errors="ignore")}
-        line = obj['fp'].readline()
-        if line == '':
-            obj['eof'] = 'Z'
-            nEOF+=1
-            obj['host']=''
-        else:
-            obj['eof'] = 'A'
-            p = line.find(" {\"")
-            if agghost:
-                obj['host'] = simplifyhost(psl, args, line[0:p])
-            else:
-                obj['host'] = line[0:p]
-            obj['years'] = json.loads(line[p+1:])
-        fil.append(obj)
-    fil.sort(key=lambda x:x['eof']+x['host'])
+    fil = [summary_file.read_summary(f) for f in args.file]
     d = {}
     lasthost = ''
-    while nEOF < len(fil):
-        h = fil[0]['host']
+    for h, years in merge_entries(fil, key):
         if h != lasthost:
             if lasthost != '':
                 output_host(args, lasthost, d)
                 d = {}
             lasthost = h
-        for year, values in fil[0]['years'].items():
-            varr = mime_counter.from_dict(values)
+        for year, varr in years:
             if args.yearly:
                 year = year[0:4]
             if year in d:
-                for i, vi in enumerate(varr):
-                    d[year][i] += vi
+                mime_counter.add_counter(d[year], varr)
             else:
                 d[year] = varr
-        line = fil[0]['fp'].readline()
-        if line == '':
-            fil[0]['eof'] = 'Z'
-            nEOF+=1
-        else:
-            p = line.find(" {\"")
-            if agghost:
-                fil[0]['host'] = simplifyhost(psl, args, line[0:p])
-            else:
-                fil[0]['host'] = line[0:p]
-            fil[0]['years'] = json.loads(line[p+1:])
-        fil.sort(key=lambda x:x['eof']+x['host'])
     if lasthost != '':
         output_host(args, lasthost, d)
     # close all files
-    for o in fil:
-        o['fp'].close()
+    for it in fil:
+        it.close()
+
+# the output file of a host: stdout or its partition file
+def output_file(host):
+    if Partitions:
+        return Partitions[summary_file.partition_of(host, len(Partitions))]
+    return sys.stdout
+
+# ----- Parallel combine (--workers)
+# The aggregation keys (hosts) are split into hash partitions, one per worker. Each worker reads all
+# the files but only decodes and adds the lines of the hosts of its partition, in the order of the
+# files as a single process does. The partitions have no host in common, the sorted output of each
+# worker only has to be merged with the others, not added up. A line that can not be decoded only
+# stops reading the file in the worker of its host, a line without host (or a file that can not be
+# read) in all the workers, the errors are reported once per file by the parent
+# runs in a worker: writes the combined hosts of partition i of n to a temporary file in the output
+# format and returns its name and the errors of the files as (file, message)
+def combine_partition(task):
+    args, i, n = task
+    errors = []
+    for f in args.file:
+        try:
+            addFile(args, f, (i, n))
+        except Exception as inst:
+            errors.append((f, str(inst)))
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.part', delete=False) as out:
+        outputResults(args, out)
+    return out.name, errors
+
+def read_partition(filename):
+    with open(filename, 'r', encoding='utf-8') as fil:
+        for line in fil:
+            yield line[0:line.find(' {')], line
+
+def dowork_parallel(args):
+    tasks = [(args, i, args.workers) for i in range(args.workers)]
+    with multiprocessing.Pool(args.workers) as pool:
+        results = pool.map(combine_partition, tasks)
+    parts = [name for name, errors in results]
+    # one error per file as in a single process, the one of the first partition that has one
+    reported = {}
+    for name, errors in results:
+        for f, message in errors:
+            reported.setdefault(f, message)
+    for f in args.file:
+        if f in reported:
+            print_to_stderr("Error", reported.pop(f), f)
+    for host, line in heapq.merge(*[read_partition(f) for f in parts]):
+        if Writer is not None:
+            entry = json.loads(line[len(host) + 1:])
+            Writer.add(host, [(date, mime_counter.from_dict(values)) for date, values in entry.items()])
+        else:
+            output_file(host).write(line)
+    for f in parts:
+        os.remove(f)
 
 def dowork(args):
+    global Writer, Partitions
+    if args.binary:
+        Writer = summary_file.SummaryWriter(args.binary)
+    if args.partitions:
+        Partitions = summary_file.open_partitions(args.partition_prefix, args.partitions)
+    if args.aggregatehosts == 'publicsuffixlist':
+        CdxParser.public_suffix_list()
     if args.assume_unique:
         read_sorted(args)
+    elif args.workers > 1:
+        dowork_parallel(args)
     else:
-        if args.aggregatehosts == 'publicsuffixlist':
-            psl = PublicSuffixList()
-        else:
-            psl = None
         for f in args.file:
             try:
-                addFile(args, f, psl)
+                addFile(args, f)
             except Exception as inst:
                 print_to_stderr("Error", inst, f)
         outputResults(args)
+    if Writer is not None:
+        Writer.close()
+    for out in Partitions:
+        out.close()
 
-parser = ArgumentParser(description='Combine summary files generated by cdx-summary.py')
-parser.add_argument('--yearly', action="store_true", help='force output into yearly buckets')
-parser.add_argument('--compact', action="store_true", help='do not output fields that are 0')
-parser.add_argument('--aggregatehosts', choices=['none','lvl2', 'publicsuffixlist'], help='Aggregate hosts (incompatible with --assume_unique when full hosts are in the input file)')
-parser.add_argument('--assume_unique', action="store_true", default=False, help='assume aggregation entry only appears in a continous run in the CDX file(s)')
-parser.add_argument('file', nargs='*', help='summary file (can be several)')
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Combine summary files generated by cdx-summary.py')
+    parser.add_argument('--yearly', action="store_true", help='force output into yearly buckets')
+    parser.add_argument('--compact', action="store_true", help='do not output fields that are 0')
+    parser.add_argument('--aggregatehosts', choices=['none','lvl2', 'publicsuffixlist'], help='Aggregate hosts (incompatible with --assume_unique when full hosts are in the input file)')
+    parser.add_argument('--assume_unique', action="store_true", default=False, help='assume aggregation entry only appears in a continous run in the CDX file(s)')
+    parser.add_argument('--binary', action="store", metavar='FILE', help='write the result in the binary summary format to FILE (- for stdout) instead of JSONL to stdout')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes, each combines the hosts of a hash partition of all the files (default 1, ignored with --assume_unique)')
+    parser.add_argument('--partitions', type=int, default=0, metavar='N', help='write the result to N sorted partition files PREFIX-I-of-N.summary by hash of the host instead of stdout')
+    parser.add_argument('--partition_prefix', action="store", default='part', metavar='PREFIX', help='prefix of the partition files (default part)')
+    parser.add_argument('file', nargs='*', help='summary file, JSONL or binary (can be several)')
 
-args = parser.parse_args()
-dowork(args)
+    args = parser.parse_args()
+    if args.partitions and args.binary:
+        parser.error('--partitions writes JSONL partition files, --binary can not be used with it')
+    dowork(args)
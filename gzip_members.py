@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# Member index of gzip files made of several concatenated gzip members (e.g. ZipNum shards)
+# The members can be decompressed independently, cdx-summarize.py uses the index to summarize
+# groups of members in parallel. The index is found by decompressing the file once and can be
+# saved in a sidecar file (gzip file name + '.members'), the size and modification time of the
+# gzip file are kept in it so that an out of date index is detected.
+#   header          MEMBERS_MAGIC, size of the gzip file, modification time in ns and
+#                   number of members (uint64)
+#   offsets         uint64[members + 1], offset of each member in the gzip file and size of the file
+#   sizes           uint64[members], uncompressed size of each member
+#   line ends       uint8[members], 1 if the member ends with a complete line
+
+from argparse import ArgumentParser
+import sys
+import os
+import zlib
+import array
+import struct
+
+MEMBERS_MAGIC = b'CDXGZMB1'
+HEADER        = struct.Struct('<8sQqQ')
+READ_SIZE     = 1024 * 1024
+
+def print_to_stderr(*a):
+    print(*a, file = sys.stderr)
+
+def index_filename(filename):
+    return filename + '.members'
+
+class MemberIndex:
+    def __init__(self, offsets, sizes, line_ends):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.line_ends = line_ends
+
+    def __len__(self):
+        return len(self.sizes)
+
+    # returns the (start, end) byte ranges of groups of consecutive members of about chunk_size
+    # uncompressed bytes, a group only ends with a member that ends with a complete line
+    def ranges(self, chunk_size):
+        ret = []
+        start = 0
+        usize = 0
+        for i in range(len(self.sizes)):
+            usize += self.sizes[i]
+            if usize >= chunk_size and self.line_ends[i]:
+                ret.append((self.offsets[start], self.offsets[i + 1]))
+                start = i + 1
+                usize = 0
+        if start < len(self.sizes):
+            ret.append((self.offsets[start], self.offsets[-1]))
+        return ret
+
+# decompress the file to find its members, a ValueError is raised if it is not a complete gzip file
+def scan_members(filename):
+    offsets = array.array('Q', [0])
+    sizes = array.array('Q')
+    line_ends = array.array('B')
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    # offset of data in the file
+    base = 0
+    usize = 0
+    last = b''
+    with open(filename, 'rb') as fil:
+        while True:
+            data = fil.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                try:
+                    out = d.decompress(data)
+                except zlib.error as inst:
+                    raise ValueError('%s: %s at offset %d' % (filename, inst, offsets[-1]))
+                if out:
+                    usize += len(out)
+                    last = out[-1:]
+                if not d.eof:
+                    base += len(data)
+                    break
+                # end of a member, the rest of data is the start of the next one
+                unused = d.unused_data
+                base += len(data) - len(unused)
+                offsets.append(base)
+                sizes.append(usize)
+                line_ends.append(last == b'\n')
+                d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                usize = 0
+                last = b''
+                data = unused
+    if base != offsets[-1] or not sizes:
+        raise ValueError('%s: incomplete gzip member at offset %d' % (filename, offsets[-1]))
+    return MemberIndex(offsets, sizes, line_ends)
+
+def write_index(filename, index, indexname=None):
+    if indexname is None:
+        indexname = index_filename(filename)
+    st = os.stat(filename)
+    with open(indexname, 'wb') as out:
+        out.write(HEADER.pack(MEMBERS_MAGIC, st.st_size, st.st_mtime_ns, len(index)))
+        for a in (index.offsets, index.sizes):
+            a = array.array('Q', a)
+            if sys.byteorder != 'little':
+                a.byteswap()
+            a.tofile(out)
+        index.line_ends.tofile(out)
+
+# returns the index saved for the file or None if there is none or it is out of date
+def read_index(filename, indexname=None):
+    if indexname is None:
+        indexname = index_filename(filename)
+    if not os.path.exists(indexname):
+        return None
+    st = os.stat(filename)
+    with open(indexname, 'rb') as fil:
+        magic, size, mtime_ns, n = HEADER.unpack(fil.read(HEADER.size))
+        if magic != MEMBERS_MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        a = []
+        for count in (n + 1, n):
+            q = array.array('Q')
+            q.frombytes(fil.read(8 * count))
+            if sys.byteorder != 'little':
+                q.byteswap()
+            a.append(q)
+        line_ends = array.array('B')
+        line_ends.frombytes(fil.read(n))
+    return MemberIndex(a[0], a[1], line_ends)
+
+# returns the index of the file from its sidecar file, with scan the file is decompressed to find
+# its members if needed and the index is saved (if the directory is writable)
+def member_index(filename, scan=False):
+    index = read_index(filename)
+    if index is None and scan:
+        index = scan_members(filename)
+        try:
+            write_index(filename, index)
+        except OSError:
+            pass
+    return index
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Write the member index FILE.members of gzip files made of several gzip members')
+    parser.add_argument('file', nargs='+', help='gzip file (can be several)')
+    args = parser.parse_args()
+    for f in args.file:
+        try:
+            index = scan_members(f)
+            write_index(f, index)
+            print_to_stderr(index_filename(f) + ':', len(index), 'members')
+        except Exception as inst:
+            print_to_stderr("Error", inst, f)
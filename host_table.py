@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+# Aggregation table module
+# Holds the mime_counter counters per aggregation key (host) and date. Hosts and
+# dates are interned and the counters of all the (host, date) cells are kept in
+# a single array of 64 bit integers which grows by chunks, instead of one python
+# list of integers per cell. The cells of a host are found through its chain of
+# rows, or for a host with many cells through its array of the rows by date id.
+
+import array
+import mime_counter
+
+TOTAL       = mime_counter.TOTAL
+N_TOTAL     = mime_counter.N_TOTAL
+S_TOTAL     = mime_counter.S_TOTAL
+S_FIRST     = mime_counter.S_FIRST
+N_HTTP      = mime_counter.N_HTTP
+S_HTTP      = mime_counter.S_HTTP
+N_HTTPS     = mime_counter.N_HTTPS
+S_HTTPS     = mime_counter.S_HTTPS
+mime_category = mime_counter.mime_category
+# the arrays grow by a quarter of their size, at least FIRST_ROWS and at most CHUNK_ROWS cells at
+# once, so that a small table does not pay for a whole chunk. They are extended by FIRST_ROWS
+# rows at a time from these zeros, a temporary buffer of the size of the whole growth would raise
+# the peak
+FIRST_ROWS  = 64
+CHUNK_ROWS  = 4096
+ZERO_DATES  = array.array('i', bytes(4 * FIRST_ROWS))
+ZERO_NEXT   = array.array('q', bytes(8 * FIRST_ROWS))
+ZERO_ROWS   = array.array('q', bytes(8 * FIRST_ROWS * TOTAL))
+NO_ROW      = -1
+# a host with more cells has an array of its rows by date id instead of walking its chain of rows,
+# if the array has at most DATES_PER_CELL entries (of 4 bytes) per cell of the host
+CHAIN_CELLS = 4
+DATES_PER_CELL = 16
+# approximate memory used per host besides the arrays (dictionary entries, keys and ids)
+HOST_OVERHEAD = 150
+
+class HostTable:
+    def __init__(self):
+        # hosts are interned to ids, the rows of a host are chained in the order they were added
+        # the row is the index of the cell in the arrays
+        self.host_ids = {}
+        self.host_names = []
+        self.host_first = array.array('q')
+        self.host_last = array.array('q')
+        self.host_cells = array.array('i')
+        self.free_hosts = []
+        # per host id: the array of its rows by date id (see CHAIN_CELLS), or None
+        self.date_rows = []
+        self.date_rows_size = 0
+        # dates are interned to ids
+        self.date_ids = {}
+        self.date_values = []
+        # per row: the date id, the next row of the same host and the TOTAL counters
+        self.row_date = array.array('i')
+        self.row_next = array.array('q')
+        self.counters = array.array('q')
+        self.nrows = 0
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.host_ids)
+
+    def __contains__(self, host):
+        return host in self.host_ids
+
+    def ncells(self):
+        return self.nrows - len(self.free_rows)
+
+    # approximate number of bytes used by the table
+    def memory_usage(self):
+        return (self.counters.itemsize * len(self.counters) + self.row_next.itemsize * len(self.row_next)
+            + self.row_date.itemsize * len(self.row_date) + 4 * self.date_rows_size + HOST_OVERHEAD * len(self.host_ids))
+
+    # returns the row of the cell (host, date), a new cell is created if needed
+    def row(self, host, date):
+        hid = self.host_ids.get(host)
+        did = self.date_ids.get(date)
+        if hid is None or did is None:
+            return self.new_row(host, date)
+        rows = self.date_rows[hid]
+        if rows is not None:
+            r = rows[did] if did < len(rows) else NO_ROW
+            if r == NO_ROW:
+                return self.new_row(host, date)
+            return r
+        # the last row first, the records of a host often come by date
+        r = self.host_last[hid]
+        row_date = self.row_date
+        row_next = self.row_next
+        if r != NO_ROW and row_date[r] != did:
+            r = self.host_first[hid]
+            while r != NO_ROW and row_date[r] != did:
+                r = row_next[r]
+        if r == NO_ROW:
+            return self.new_row(host, date)
+        return r
+
+    # returns the id of the host, it is added to the table (without any cell) if needed
+    def host_id(self, host):
+        hid = self.host_ids.get(host)
+        if hid is None:
+            if self.free_hosts:
+                hid = self.free_hosts.pop()
+                self.host_names[hid] = host
+            else:
+                hid = len(self.host_names)
+                self.host_names.append(host)
+                self.host_first.append(NO_ROW)
+                self.host_last.append(NO_ROW)
+                self.host_cells.append(0)
+                self.date_rows.append(None)
+            self.host_ids[host] = hid
+        return hid
+
+    def new_row(self, host, date):
+        hid = self.host_id(host)
+        did = self.date_ids.get(date)
+        if did is None:
+            did = len(self.date_values)
+            self.date_values.append(date)
+            self.date_ids[date] = did
+        if self.free_rows:
+            r = self.free_rows.pop()
+            o = r * TOTAL
+            self.counters[o:o + TOTAL] = array.array('q', bytes(8 * TOTAL))
+        else:
+            r = self.nrows
+            if r == len(self.row_next):
+                n = min(CHUNK_ROWS, max(FIRST_ROWS, r // 4)) // FIRST_ROWS
+                for i in range(n):
+                    self.row_date.extend(ZERO_DATES)
+                    self.row_next.extend(ZERO_NEXT)
+                    self.counters.extend(ZERO_ROWS)
+            self.nrows = r + 1
+        self.row_date[r] = did
+        self.row_next[r] = NO_ROW
+        last = self.host_last[hid]
+        if last == NO_ROW:
+            self.host_first[hid] = r
+        else:
+            self.row_next[last] = r
+        self.host_last[hid] = r
+        rows = self.date_rows[hid]
+        if rows is not None:
+            if did < len(rows):
+                rows[did] = r
+            else:
+                self.set_date_row(rows, did, r)
+            return r
+        n = self.host_cells[hid] + 1
+        self.host_cells[hid] = n
+        if n > CHAIN_CELLS and len(self.date_values) <= n * DATES_PER_CELL:
+            rows = self.date_rows[hid] = array.array('i')
+            c = self.host_first[hid]
+            while c != NO_ROW:
+                self.set_date_row(rows, self.row_date[c], c)
+                c = self.row_next[c]
+        return r
+
+    def set_date_row(self, rows, did, r):
+        if did >= len(rows):
+            n = len(self.date_values) - len(rows)
+            rows.extend(array.array('i', [NO_ROW]) * n)
+            self.date_rows_size += n
+        rows[did] = r
+
+    # count one CDX record
+    def add_record(self, host, date, mime, scheme, size):
+        r = self.row(host, date)
+        # same as mime_counter.add_mime() and add_scheme() on the cell
+        o = r * TOTAL
+        c = self.counters
+        i = o + mime_category(mime)
+        c[o + N_TOTAL] += 1
+        c[o + S_TOTAL] += size
+        c[i] += 1
+        c[i + S_FIRST] += size
+        if scheme == 'http':
+            c[o + N_HTTP] += 1
+            c[o + S_HTTP] += size
+        elif scheme == 'https':
+            c[o + N_HTTPS] += 1
+            c[o + S_HTTPS] += size
+
+    # count n CDX records of the same host, date, mime type and scheme with a total size
+    def add_records(self, host, date, mime, scheme, n, size):
+        r = self.row(host, date)
+        o = r * TOTAL
+        c = self.counters
+        i = o + mime_category(mime)
+        c[o + N_TOTAL] += n
+        c[o + S_TOTAL] += size
+        c[i] += n
+        c[i + S_FIRST] += size
+        if scheme == 'http':
+            c[o + N_HTTP] += n
+            c[o + S_HTTP] += size
+        elif scheme == 'https':
+            c[o + N_HTTPS] += n
+            c[o + S_HTTPS] += size
+
+    # add a counter (list of TOTAL values) to the cell (host, date)
+    def add_counter(self, host, date, counter):
+        o = self.row(host, date) * TOTAL
+        c = self.counters
+        for i, vi in enumerate(counter):
+            c[o + i] += vi
+
+    # returns the list of (date, counter) of a host in the order the dates were added
+    def dates(self, host):
+        ret = []
+        r = self.host_first[self.host_ids[host]]
+        while r != NO_ROW:
+            o = r * TOTAL
+            ret.append((self.date_values[self.row_date[r]], self.counters[o:o + TOTAL].tolist()))
+            r = self.row_next[r]
+        return ret
+
+    # same as dates() but the host is removed from the table and its cells are reused
+    def pop(self, host):
+        ret = self.dates(host)
+        hid = self.host_ids.pop(host)
+        r = self.host_first[hid]
+        while r != NO_ROW:
+            self.free_rows.append(r)
+            r = self.row_next[r]
+        rows = self.date_rows[hid]
+        if rows is not None:
+            self.date_rows_size -= len(rows)
+            self.date_rows[hid] = None
+        self.host_names[hid] = None
+        self.host_first[hid] = NO_ROW
+        self.host_last[hid] = NO_ROW
+        self.host_cells[hid] = 0
+        self.free_hosts.append(hid)
+        return ret
+
+    def hosts(self):
+        return self.host_ids.keys()
+
+    # add all the counters of another table, dates new to a host are added after the existing ones
+    def merge(self, other):
+        for host in other.hosts():
+            for date, counter in other.dates(host):
+                self.add_counter(host, date, counter)
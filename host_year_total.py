@@ -4,11 +4,33 @@ from argparse import ArgumentParser
 import sys
 import json
 import mime_counter
+import summary_file
 
 def print_to_stderr(*a):
 	print(*a, file = sys.stderr)
 
+# same as addFile for a binary summary file, only the total columns are read
+def addBinaryFile(args, filename):
+	with summary_file.SummaryReader(filename) as reader:
+		n_total = reader.column('n_total')
+		s_total = reader.column('s_total')
+		for i in range(len(reader)):
+			host = reader.host(i)
+			start, end = reader.rows(i)
+			if args.nototal and args.noyear:
+				print(host)
+			elif args.nototal:
+				for year in sorted(str(reader.dates[r]) for r in range(start, end)):
+					print(host,year)
+			else:
+				for year, r in sorted((str(reader.dates[r]), r) for r in range(start, end)):
+					if n_total[r] > 0:
+						print(host,year,n_total[r],s_total[r])
+
 def addFile(args, filename):
+	if summary_file.is_binary(filename):
+		addBinaryFile(args, filename)
+		return
 	f = open(filename, 'r', errors="ignore")
 	for line in f:
 		p = line.find(" {\"")
@@ -37,7 +59,7 @@ def dowork(args):
 parser = ArgumentParser(description='extract a space-delimited file with the columns host [year] [n_total] [s_total] webarchive from a summary file')
 parser.add_argument('-nototal', action="store_true", help='do not output the n_total and s_total columns')
 parser.add_argument('-noyear', action="store_true", help='do not output the year column')
-parser.add_argument('file', nargs='*', help='summary file (can be several)')
+parser.add_argument('file', nargs='*', help='summary file, JSONL or binary (can be several)')
 
 args = parser.parse_args()
 dowork(args)
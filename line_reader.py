@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+# Pipelined reading of (compressed) text files
+# A background thread reads, decompresses and decodes the file by chunks of about a megabyte and
+# hands the lines of each chunk to the thread that parses them through a bounded queue. zlib and
+# the reads from a pipe release the GIL, so the decompression overlaps with the parsing. The file
+# can also be decompressed by an external process (pigz or zcat) whose output is read from a pipe
+# by the thread.
+# The lines are the same as those of gzip.open(filename, 'rt') or open(filename, 'r').
+
+import io
+import gzip
+import codecs
+import queue
+import shutil
+import threading
+import subprocess
+
+# number of bytes read at once, the lines of a chunk are handed over together
+CHUNK_BYTES = 1 << 20
+# number of chunks waiting to be parsed
+QUEUE_SIZE  = 8
+# external decompressors in the order of preference for 'auto'
+COMMANDS    = {'pigz': ['pigz', '-dc'], 'zcat': ['zcat']}
+
+# returns the external command used for decompressor ('python', 'pigz', 'zcat' or 'auto'), None for python's gzip
+def command_of(decompressor):
+    if decompressor == 'auto':
+        for name in COMMANDS:
+            if shutil.which(COMMANDS[name][0]):
+                return COMMANDS[name]
+        return None
+    return COMMANDS.get(decompressor)
+
+class ThreadedLineReader:
+    def __init__(self, filename, encoding='utf-8', gz=False, command=None, chunk_bytes=CHUNK_BYTES, queue_size=QUEUE_SIZE):
+        self.process = None
+        if gz and command:
+            self.process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE)
+            self.fil = self.process.stdout
+        elif gz:
+            self.fil = gzip.open(filename, mode='rb')
+        else:
+            self.fil = open(filename, 'rb')
+        # decodes as a text file: with universal newlines, '\r\n' and '\r' become '\n'
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), True)
+        self.chunk_bytes = chunk_bytes
+        self.queue = queue.Queue(queue_size)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.lines = self.generate()
+
+    # runs in the thread: each item of the queue is a list of lines, an exception or None at the end
+    # the lines read before an error (e.g. a truncated file) are handed over before the exception
+    # read1() returns what a single read decompressed (about 45KB from gzip, 32KB from a pipe), the
+    # pieces are gathered into chunks of CHUNK_BYTES so that the lines are handed over in few items
+    def run(self):
+        last = ''
+        try:
+            end = False
+            while not end:
+                pieces = []
+                size = 0
+                try:
+                    while size < self.chunk_bytes:
+                        data = self.fil.read1(self.chunk_bytes - size)
+                        if not data:
+                            end = True
+                            break
+                        pieces.append(data)
+                        size += len(data)
+                except Exception:
+                    self.put_lines(last, b''.join(pieces), False)
+                    raise
+                last = self.put_lines(last, b''.join(pieces), end)
+                if self.stopped:
+                    return
+            if last:
+                self.queue.put([last])
+            if self.process is not None and self.process.wait() != 0:
+                raise OSError('%s exited with status %d' % (' '.join(self.process.args), self.process.returncode))
+            self.queue.put(None)
+        except Exception as inst:
+            self.queue.put(inst)
+
+    # decodes data and hands over the complete lines of last + data, returns the partial last line
+    # the text is split on '\n' only, splitlines() would also split on '\x0c', '\x85', '\u2028' ...
+    def put_lines(self, last, data, final):
+        try:
+            text = self.decoder.decode(data, final)
+        except UnicodeDecodeError as inst:
+            # the complete lines before the undecodable bytes are handed over, inst.object starts
+            # with the bytes left undecoded by the previous chunk
+            self.decoder.setstate((b'', self.decoder.getstate()[1]))
+            self.put_lines(last, inst.object[:inst.start], True)
+            raise
+        lines = (last + text).split('\n')
+        last = lines.pop()
+        if lines:
+            self.queue.put([line + '\n' for line in lines])
+        return last
+
+    def generate(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+    def readline(self):
+        return next(self.lines, '')
+
+    def __iter__(self):
+        return self.lines
+
+    # the thread is stopped if the lines were not all read, it is then waiting for room in the queue
+    def close(self):
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        self.fil.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
@@ -3,6 +3,7 @@
 # MIME summarizer module
 
 import array
+import functools
 
 N_HTML      = 0
 N_IMAGE     = 1
@@ -36,39 +37,44 @@ TOTAL       = S_TOTAL + 1
 def init_counter():
     return [0] * TOTAL 
 
-def add_mime(a, mime, count = 1, size = 0):
-    a[N_TOTAL] += count
-    a[S_TOTAL] += size
+# number of distinct media types whose category is remembered, the least recently
+# used ones are forgotten so that junk values from broken servers can't fill the memory
+MIME_CACHE_SIZE = 8192
+
+@functools.lru_cache(maxsize=MIME_CACHE_SIZE)
+def mime_category(mime):
     if mime == "text/html" or mime == "application/xhtml+xml" or mime == "text/plain":
-        a[N_HTML] += count
-        a[S_HTML] += size
+        return N_HTML
     elif mime == "text/css":
-        a[N_CSS] += count
-        a[S_CSS] += size
+        return N_CSS
     elif mime.find("image/") == 0:
-        a[N_IMAGE] += count
-        a[S_IMAGE] += size
+        return N_IMAGE
     elif mime == "application/pdf":
-        a[N_PDF] += count
-        a[S_PDF] += size
+        return N_PDF
     elif mime.find("video/") == 0:
-        a[N_VIDEO] += count
-        a[S_VIDEO] += size
+        return N_VIDEO
     elif mime.find("audio/") == 0:
-        a[N_AUDIO] += count
-        a[S_AUDIO] += size
+        return N_AUDIO
     elif mime == "application/javascript" or mime == "text/javascript" or  mime == "application/x-javascript":
-        a[N_JS] += count
-        a[S_JS] += size
+        return N_JS
     elif mime == "application/json" or mime == "text/json":
-        a[N_JSON] += count
-        a[S_JSON] += size
+        return N_JSON
     elif mime.find("font/") == 0 or mime == "application/vnd.ms-fontobject" or mime.find("application/font") == 0 or mime.find("application/x-font") == 0:
-        a[N_FONT] += count
-        a[S_FONT] += size
+        return N_FONT
     else:
-        a[N_OTHER] += count
-        a[S_OTHER] += size
+        return N_OTHER
+
+# returns (hits, misses, current size) of the media type cache
+def cache_stats():
+    info = mime_category.cache_info()
+    return info.hits, info.misses, info.currsize
+
+def add_mime(a, mime, count = 1, size = 0):
+    i = mime_category(mime)
+    a[N_TOTAL] += count
+    a[S_TOTAL] += size
+    a[i] += count
+    a[S_FIRST + i] += size
 
 def add_scheme(a, scheme, count = 1, size = 0):
     if scheme == 'http':
@@ -78,6 +84,10 @@ def add_scheme(a, scheme, count = 1, size = 0):
         a[N_HTTPS] += count
         a[S_HTTPS] += size
 
+def add_counter(a, b):
+    for i, vi in enumerate(b):
+        a[i] += vi
+
 def as_dict(a):
     return {
         'n_html': a[N_HTML],
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# Minimal stand-in for an OutbackCDX server to test and benchmark cdx-summarize-outbackcdx.py
+# Each file of the directory is a collection named after the file without its extension,
+# containing sorted cdxNbamskrMSVg lines. It answers /api/collections and range queries
+# /COLLECTION?url=KEY&matchType=range with the lines from the SURT key KEY to the end.
+# The filter ([!]field:regex, can be given several times) and fl (fields to output) parameters
+# are supported for the fields of the cdxNbamskrMSVg lines.
+
+from argparse import ArgumentParser
+import sys
+import os
+import json
+import time
+import re
+import bisect
+import urllib.parse
+import http.server
+
+def print_to_stderr(*a):
+    print(*a, file = sys.stderr)
+
+FIELDS = ['urlkey', 'timestamp', 'original', 'mimetype', 'statuscode', 'digest', 'redirecturl', 'robotflags', 'length', 'offset', 'filename']
+
+# returns the lines that match all the filters with only the fields of fl
+def filter_lines(lines, filters, fl):
+    tests = []
+    for f in filters:
+        negate = f.startswith('!')
+        field, regex = f.lstrip('!').split(':', 1)
+        tests.append((FIELDS.index(field), re.compile(regex), negate))
+    columns = [FIELDS.index(field) for field in fl.split(',')] if fl else None
+    ret = []
+    for line in lines:
+        fields = line.decode('utf-8', errors="ignore").split()
+        fields += ['-'] * (len(FIELDS) - len(fields))
+        if all((regex.fullmatch(fields[i]) is None) == negate for i, regex, negate in tests):
+            ret.append(line if columns is None else (' '.join(fields[i] for i in columns) + '\n').encode('utf-8'))
+    return ret
+
+class Collection:
+    def __init__(self, filename):
+        with open(filename, 'rb') as fil:
+            lines = [line for line in fil if line.strip() and not line.startswith(b' CDX')]
+        lines.sort(key=lambda line: line[0:line.find(b' ')])
+        self.keys = [line[0:line.find(b' ')].decode('utf-8', errors="ignore") for line in lines]
+        self.lines = lines
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, lines):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(sum(len(line) for line in lines)))
+        self.end_headers()
+        args = self.server.args
+        try:
+            for i in range(0, len(lines), args.chunk_lines):
+                if args.delay:
+                    time.sleep(args.delay)
+                self.wfile.write(b''.join(lines[i:i + args.chunk_lines]))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. at the end of its key range
+            self.close_connection = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        name = url.path.strip('/')
+        if name == 'api/collections':
+            self.send_body([json.dumps(sorted(self.server.collections)).encode('utf-8')])
+            return
+        if not name in self.server.collections:
+            self.send_error(404)
+            return
+        collection = self.server.collections[name]
+        query = urllib.parse.parse_qs(url.query)
+        start = query.get('url', [''])[0]
+        if query.get('matchType', ['exact'])[0] != 'range':
+            self.send_error(400, 'only matchType=range is supported')
+            return
+        lines = collection.lines[bisect.bisect_left(collection.keys, start):]
+        if 'filter' in query or 'fl' in query:
+            try:
+                lines = filter_lines(lines, query.get('filter', []), query.get('fl', [None])[0])
+            except ValueError as inst:
+                self.send_error(400, str(inst))
+                return
+        self.send_body(lines)
+
+    def log_message(self, format, *a):
+        if self.server.args.verbose:
+            print_to_stderr(format % a)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve the cdx files of a directory like an OutbackCDX server, for testing cdx-summarize-outbackcdx.py')
+    parser.add_argument('--port', type=int, default=8084, help='port to listen on (default 8084)')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before sending each chunk of lines, to simulate a slow server (default 0)')
+    parser.add_argument('--chunk_lines', type=int, default=1000, help='number of lines sent at once (default 1000)')
+    parser.add_argument('--verbose', action="store_true", help='log the requests to stderr')
+    parser.add_argument('directory', help='directory with one sorted cdxNbamskrMSVg file per collection')
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    server.args = args
+    server.collections = {}
+    for f in sorted(os.listdir(args.directory)):
+        server.collections[os.path.splitext(f)[0]] = Collection(os.path.join(args.directory, f))
+    print_to_stderr('serving', len(server.collections), 'collections on port', args.port)
+    server.serve_forever()
@@ -2,14 +2,7 @@
 from argparse import ArgumentParser
 import sys
 import json
-
-COLUMN_INDEX    = 0
-COLUMN_FILENAME = 1
-COLUMN_FILEPTR  = 2
-COLUMN_KEY      = 3
-COLUMN_LINE     = 4
-COLUMN_YEAR     = 5
-
+import heapq
 
 RES_COUNT    = 0
 RES_N        = 1
@@ -18,86 +11,86 @@ RES_SIZE     = 2
 def print_to_stderr(*a): 
     print(*a, file = sys.stderr)
 
+# returns (key, file index, year, n_total, s_total) for each line of the file with index i, the key is
+# the host (and year) part of the line and is compared as a string, n_total and s_total are only read
+# when they are summed. These are the items of the heap used to merge the files
+def read_lines(args, fp, i, nkey):
+    sep = args.sep
+    noyear = args.noyear
+    nototal = args.nototal
+    for l in fp:
+        splitline = l.split(sep)
+        k = sep.join(splitline[0:nkey])
+        year = None if noyear else int(splitline[1])
+        if nototal:
+            yield k, i, year, 0, 0
+        else:
+            yield k, i, year, int(splitline[-2]), int(splitline[-1])
+
+# the files are merged with a heap, the files that have the smallest key form a group
+# and the combination of files of the group is a bitmask of their indices
 def dowork(args):
-    fd = []
     if args.noyear:
         nkey = 1
     else:
         nkey = 2
-    all_eof = True
-    i = 0
-    for f in args.file:
+    fps = []
+    files = []
+    heap = []
+    for i, f in enumerate(args.file):
         fp = open(f, 'r')
-        l = fp.readline()
-        if not l == '':
-            all_eof = False
-            splitline = l.split(args.sep)
-            k = args.sep.join(splitline[0:nkey])
-            if args.noyear:
-                fd.append([i, f, fp, k, l])
-            else:
-                fd.append([i, f, fp, k, l, int(splitline[1])])
-        i = i + 1
-    # sort the files by their key
-    fd.sort(key=lambda k:k[COLUMN_KEY])
+        fps.append(fp)
+        files.append(read_lines(args, fp, i, nkey))
+        item = next(files[i], None)
+        if item is not None:
+            heap.append(item)
+    heapq.heapify(heap)
+    heappop = heapq.heappop
+    heappush = heapq.heappush
     res = {}
     lastkey = ''
-    while not all_eof:
-        # first find out how many files have the same key on the current line
-        nequal = 1
-        keyfound = {fd[0][COLUMN_INDEX]:0}
-        while nequal < len(fd) and fd[nequal][COLUMN_KEY] == fd[0][COLUMN_KEY]:
-            keyfound[fd[nequal][COLUMN_INDEX]] = nequal
-            nequal = nequal + 1
-        # save the number of common lines for that file combination and their 2 last columns if needed
-        skeyfound = sorted(keyfound.keys())
-        reskey = '-'.join([str(x) for x in skeyfound])
-        if not args.noyear:
-            year = fd[0][COLUMN_YEAR]
-        if not reskey in res:
+    while heap:
+        # first find out which files have the same key on the current line
+        key = heap[0][0]
+        group = [heappop(heap)]
+        while heap and heap[0][0] == key:
+            group.append(heappop(heap))
+        mask = 0
+        for item in group:
+            mask |= 1 << item[1]
+        # the counters of a combination (and year) are allocated once: the count followed by the 2 last columns of each file
+        counters = res.get(mask)
+        if counters is None:
             if args.noyear:
-                res[reskey] = [0] * (1 + (2 * nequal if not args.nototal else 0))
+                counters = [0] * (1 + (2 * len(group) if not args.nototal else 0))
             else:
-                res[reskey] = {}
-        if not args.noyear and not year in res[reskey]:
-            res[reskey][year] = [0] * (1 + (2 * nequal if not args.nototal else 0))
+                counters = {}
+            res[mask] = counters
+        if not args.noyear:
+            year = group[0][2]
+            if not year in counters:
+                counters[year] = [0] * (1 + (2 * len(group) if not args.nototal else 0))
+            counters = counters[year]
         # if the key hasn't changed from the last line from the file(s), we don't need to increase the counter
-        if not fd[0][COLUMN_KEY] == lastkey:
-            if args.noyear:
-                res[reskey][RES_COUNT] += 1
-            else:
-                res[reskey][year][RES_COUNT] += 1
-        lastkey = fd[0][COLUMN_KEY]
+        if key != lastkey:
+            counters[RES_COUNT] += 1
+        lastkey = key
         # keep adding the sums of the last two columns if wanted
         if not args.nototal:
-            i = 0
-            for k in skeyfound:
-                tmpline = fd[keyfound[k]][COLUMN_LINE].split(args.sep)
-                if args.noyear:
-                    res[reskey][RES_N + 2 * i] += int(tmpline[-2])
-                    res[reskey][RES_SIZE + 2 * i] += int(tmpline[-1])
-                else:
-                    res[reskey][year][RES_N + 2 * i] += int(tmpline[-2])
-                    res[reskey][year][RES_SIZE + 2 * i] += int(tmpline[-1])
-                i = i + 1
+            j = RES_N
+            for item in group:
+                counters[j] += item[3]
+                counters[j + 1] += item[4]
+                j += 2
         # read the next line for those files who had the same key
-        i = 0
-        while i < nequal and i < len(fd):
-            l = fd[i][COLUMN_FILEPTR].readline()
-            if l == '':
-                del fd[i]
-            else:
-                splitline = l.split(args.sep)
-                k = args.sep.join(splitline[0:nkey])
-                fd[i][COLUMN_KEY] = k
-                fd[i][COLUMN_LINE] = l
-                if not args.noyear:
-                    fd[i][COLUMN_YEAR] = int(splitline[1])
-                i = i + 1
-        if len(fd) == 0:
-            all_eof = True
-        else:
-            fd.sort(key=lambda k:k[COLUMN_KEY])
+        for item in group:
+            item = next(files[item[1]], None)
+            if item is not None:
+                heappush(heap, item)
+    for fp in fps:
+        fp.close()
+    # the combinations as in the output: the indices of the files joined by '-'
+    res = {key_from_mask(mask): counters for mask, counters in res.items()}
     if args.csv:
         if args.noyear:
             export_as_csv_simple(args, res)
@@ -109,6 +102,14 @@ def dowork(args):
             jsonout[filename_from_key(args, k)] = res[k]
         print(json.dumps(jsonout))
 
+def key_from_mask(mask):
+    indices = []
+    while mask:
+        low = mask & -mask
+        indices.append(str(low.bit_length() - 1))
+        mask ^= low
+    return '-'.join(indices)
+
 def filename_from_key(args, k):
     filename = ''
     for e in k.split('-'):
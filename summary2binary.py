@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+
+from argparse import ArgumentParser
+import sys
+import summary_file
+
+def print_to_stderr(*a):
+	print(*a, file = sys.stderr)
+
+def dowork(args):
+	with summary_file.SummaryWriter(args.output) as writer:
+		for f in args.file:
+			try:
+				for host, dates in summary_file.read_jsonl(f):
+					writer.add(host, dates)
+			except Exception as inst:
+				print_to_stderr("Error", inst, f)
+
+parser = ArgumentParser(description='convert summary file(s) from JSONL to a single file in the binary summary format (the hosts are sorted)')
+parser.add_argument('-o', '--output', default='-', help='binary summary file to write (default is stdout)')
+parser.add_argument('file', nargs='*', help='summary file (can be several)')
+
+args = parser.parse_args()
+dowork(args)
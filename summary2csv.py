@@ -4,6 +4,7 @@ from argparse import ArgumentParser
 import sys
 import json
 import mime_counter
+import summary_file
 
 def print_to_stderr(*a):
 	print(*a, file = sys.stderr)
@@ -22,7 +23,22 @@ def print_header(args):
 		out.append(str(f))
 	print_csv_line(args, out)
 
+# same as addFile for a binary summary file
+def addBinaryFile(args, filename):
+	with summary_file.SummaryReader(filename) as reader:
+		columns = [reader.column(k) for k in sorted(summary_file.COLUMNS)]
+		for i in range(len(reader)):
+			host = reader.host(i)
+			start, end = reader.rows(i)
+			for year, r in sorted((str(reader.dates[r]), r) for r in range(start, end)):
+				values = [c[r] for c in columns]
+				if any(values):
+					print_csv_line(args, [host, year] + [str(v) for v in values])
+
 def addFile(args, filename):
+	if summary_file.is_binary(filename):
+		addBinaryFile(args, filename)
+		return
 	f = open(filename, 'r', errors="ignore")
 	keys = sorted(mime_counter.as_dict(mime_counter.init_counter()).keys())
 	for line in f:
@@ -55,7 +71,7 @@ parser = ArgumentParser(description='transform a summary file to a space-delimit
 parser.add_argument('-outsep', default=' ', help='output field separator (default is space)')
 parser.add_argument('-noheader', action="store_true", help='No header in CSV file')
 parser.add_argument('-quoted', default=False, action="store_true", help='enclose field values in double-quotes (")')
-parser.add_argument('file', nargs='*', help='summary file (can be several)')
+parser.add_argument('file', nargs='*', help='summary file, JSONL or binary (can be several)')
 
 args = parser.parse_args()
 dowork(args)
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+# Summary file module
+# Reads the .summary files (JSONL) and reads and writes the binary summary format.
+#
+# The binary format holds the same information as a .summary file in columns of
+# fixed width little endian integers, so that it can be memory-mapped and read
+# without parsing any JSON:
+#   header          MAGIC, number of columns (uint32), flags (uint32),
+#                   number of hosts, number of entries and size of the names (uint64)
+#   host offsets    uint64[hosts + 1], offset of the name of each host in the names
+#   host rows       uint64[hosts + 1], first entry of each host, the entries of a host
+#                   are the rows [host rows[i], host rows[i + 1][
+#   dates           int32[entries] (padded to 8 bytes), the year or yearmonth of each entry
+#   columns         int64[entries] for each of the mime_counter.TOTAL counters, in the
+#                   order of the mime_counter indices
+#   names           the host names sorted and encoded in utf-8, one after the other
+# An entry is a (host, date) pair of a .summary file, the hosts are sorted and the
+# entries of a host are in the same order as in the JSON object.
+
+import sys
+import json
+import mmap
+import array
+import zlib
+import struct
+import mime_counter
+
+TOTAL       = mime_counter.TOTAL
+MAGIC       = b'CDXSUMB1'
+HEADER      = struct.Struct('<8sIIQQQ')
+# name of each column, in the order of the mime_counter indices
+COLUMNS     = [k for k, i in sorted(mime_counter.as_dict(list(range(TOTAL))).items(), key=lambda x: x[1])]
+
+def is_binary(filename):
+    with open(filename, 'rb') as fil:
+        return fil.read(len(MAGIC)) == MAGIC
+
+# returns (host, list of (date, counter)) for each line of a .summary file, with accept only
+# for the hosts for which accept(host) is true, the other lines are not decoded (lines without
+# a host are, so that they raise the same error)
+def read_jsonl(filename, accept=None):
+    with open(filename, 'r', errors="ignore") as fil:
+        for line in fil:
+            p = line.find(" {\"")
+            if accept is not None and p > -1 and not accept(line[0:p]):
+                continue
+            entry = json.loads(line[p+1:])
+            yield line[0:p], [(date, mime_counter.from_dict(values)) for date, values in entry.items()]
+
+# same as read_jsonl for any summary file, binary or JSONL
+def read_summary(filename, accept=None):
+    if is_binary(filename):
+        with SummaryReader(filename) as reader:
+            if accept is None:
+                yield from reader
+                return
+            for i in range(len(reader)):
+                host = reader.host(i)
+                if accept(host):
+                    yield host, reader.entries(i)
+    else:
+        yield from read_jsonl(filename, accept)
+
+class SummaryReader:
+    def __init__(self, filename):
+        self.filename = filename
+        self.fil = open(filename, 'rb')
+        self.map = mmap.mmap(self.fil.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        magic, ncolumns, flags, self.nhosts, self.nrows, names_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('not a binary summary file: ' + filename)
+        if ncolumns != TOTAL:
+            self.close()
+            raise ValueError('unsupported number of columns %d in %s' % (ncolumns, filename))
+        pos = HEADER.size
+        self.host_offsets = self.section(pos, 'Q', self.nhosts + 1)
+        pos += 8 * (self.nhosts + 1)
+        self.host_rows = self.section(pos, 'Q', self.nhosts + 1)
+        pos += 8 * (self.nhosts + 1)
+        self.dates = self.section(pos, 'i', self.nrows)
+        pos += padded(4 * self.nrows)
+        self.columns = []
+        for i in range(TOTAL):
+            self.columns.append(self.section(pos, 'q', self.nrows))
+            pos += 8 * self.nrows
+        self.names = self.section(pos, 'B', names_size)
+
+    # the integers of a part of the file, without copying them if the byte order allows it
+    def section(self, pos, typecode, n):
+        size = array.array(typecode).itemsize
+        view = memoryview(self.map)[pos:pos + n * size]
+        self.views.append(view)
+        if typecode == 'B':
+            return view
+        if sys.byteorder == 'little':
+            view = view.cast(typecode)
+            self.views.append(view)
+            return view
+        a = array.array(typecode, bytes(view))
+        a.byteswap()
+        return a
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.map.close()
+        self.fil.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def __len__(self):
+        return self.nhosts
+
+    def host(self, i):
+        return str(self.names[self.host_offsets[i]:self.host_offsets[i + 1]], 'utf-8')
+
+    # returns the range of rows of the host with index i
+    def rows(self, i):
+        return self.host_rows[i], self.host_rows[i + 1]
+
+    def column(self, name):
+        return self.columns[COLUMNS.index(name)]
+
+    # returns the list of (date, counter) of the host with index i, the dates are strings as in a .summary file
+    def entries(self, i):
+        start, end = self.host_rows[i], self.host_rows[i + 1]
+        counters = zip(*[c[start:end].tolist() for c in self.columns])
+        return [(str(date), list(counter)) for date, counter in zip(self.dates[start:end].tolist(), counters)]
+
+    # binary search, returns the index of the first host that is not smaller than host
+    def bisect(self, host):
+        lo, hi = 0, self.nhosts
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.host(mid) < host:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # returns the index of host or -1
+    def find(self, host):
+        i = self.bisect(host)
+        if i < self.nhosts and self.host(i) == host:
+            return i
+        return -1
+
+    def __iter__(self):
+        for i in range(self.nhosts):
+            yield self.host(i), self.entries(i)
+
+# ----- Hash partitions of the hosts (--partitions of cdx-summarize.py and combine-summary.py)
+# A host is always in the same partition for a given number of partitions, so the partitions of
+# different summaries can be combined separately and the results concatenated
+def partition_of(host, n):
+    return zlib.crc32(host.encode('utf-8')) % n
+
+def partition_filename(prefix, i, n):
+    return '%s-%05d-of-%05d.summary' % (prefix, i, n)
+
+# returns the n partition files opened for writing
+def open_partitions(prefix, n):
+    return [open(partition_filename(prefix, i, n), 'w', encoding='utf-8') for i in range(n)]
+
+def padded(size):
+    return (size + 7) & ~7
+
+# collects the entries and writes the binary summary file when it is closed
+# the entries are kept in arrays until then (about 220 bytes per (host, date))
+class SummaryWriter:
+    def __init__(self, filename):
+        if filename == '-':
+            self.fil = sys.stdout.buffer
+        else:
+            self.fil = open(filename, 'wb')
+        self.names = []
+        self.host_rows = array.array('Q')
+        self.dates = array.array('i')
+        self.counters = array.array('q')
+        self.sorted = True
+
+    # add a host with its list of (date, counter)
+    def add(self, host, dates):
+        if self.names and host < self.names[-1]:
+            self.sorted = False
+        self.names.append(host)
+        self.host_rows.append(len(self.dates))
+        for date, counter in dates:
+            self.dates.append(int(date))
+            self.counters.extend(counter)
+
+    def close(self):
+        nrows = len(self.dates)
+        self.host_rows.append(nrows)
+        if not self.sorted:
+            self.sort()
+        names = [host.encode('utf-8') for host in self.names]
+        offsets = array.array('Q', [0])
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        sections = [offsets, self.host_rows, self.dates]
+        if len(self.dates) % 2:
+            sections.append(array.array('i', [0]))
+        for i in range(TOTAL):
+            sections.append(self.counters[i::TOTAL])
+        self.fil.write(HEADER.pack(MAGIC, TOTAL, 0, len(names), nrows, offsets[-1]))
+        for a in sections:
+            if sys.byteorder != 'little':
+                a.byteswap()
+            a.tofile(self.fil)
+        for name in names:
+            self.fil.write(name)
+        if self.fil is sys.stdout.buffer:
+            self.fil.flush()
+        else:
+            self.fil.close()
+
+    # put the hosts in order (sort is stable, so duplicate hosts keep their order)
+    def sort(self):
+        order = sorted(range(len(self.names)), key=self.names.__getitem__)
+        names = []
+        host_rows = array.array('Q')
+        dates = array.array('i')
+        counters = array.array('q')
+        for i in order:
+            start, end = self.host_rows[i], self.host_rows[i + 1]
+            names.append(self.names[i])
+            host_rows.append(len(dates))
+            dates.extend(self.dates[start:end])
+            counters.extend(self.counters[start * TOTAL:end * TOTAL])
+        host_rows.append(len(dates))
+        self.names, self.host_rows, self.dates, self.counters = names, host_rows, dates, counters
+        self.sorted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+# Sidecar index for sorted .summary files
+# The index (summary file name + '.idx') holds the host and the byte offset of the first
+# line starting in each block of BLOCK_SIZE bytes of the summary file. A lookup searches
+# the index with a binary search and only reads the summary file from the block where
+# the host can start. The size and modification time of the summary file are kept in the
+# index so that an out of date index is detected.
+#   header          INDEX_MAGIC, block size (uint32), padding (uint32), size of the
+#                   summary file, modification time in ns and number of blocks (uint64)
+#   block offsets   uint64[blocks], offset of the first line of each block in the summary file
+#   name offsets    uint64[blocks + 1], offset of the host of each block in the names
+#   names           the host of the first line of each block encoded in utf-8
+
+from argparse import ArgumentParser
+import sys
+import os
+import json
+import mmap
+import array
+import struct
+import summary_file
+import mime_counter
+
+INDEX_MAGIC = b'CDXSIDX1'
+HEADER      = struct.Struct('<8sIIQqQ')
+BLOCK_SIZE  = 4096
+
+def print_to_stderr(*a):
+    print(*a, file = sys.stderr)
+
+def index_filename(filename):
+    return filename + '.idx'
+
+def host_of(line):
+    return line[0:line.find(" ")]
+
+# write the index of a sorted summary file, a ValueError is raised if it is not sorted
+def build_index(filename, indexname=None, block_size=BLOCK_SIZE):
+    if indexname is None:
+        indexname = index_filename(filename)
+    st = os.stat(filename)
+    offsets = array.array('Q')
+    names = []
+    pos = 0
+    next_block = 0
+    lasthost = None
+    with open(filename, 'rb') as fil:
+        for bline in fil:
+            host = host_of(bline.decode('utf-8', errors="ignore"))
+            if lasthost is not None and host < lasthost:
+                raise ValueError('%s is not sorted (%s after %s)' % (filename, host, lasthost))
+            lasthost = host
+            if pos >= next_block:
+                offsets.append(pos)
+                names.append(host.encode('utf-8'))
+                next_block = pos + block_size
+            pos += len(bline)
+    name_offsets = array.array('Q', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+    with open(indexname, 'wb') as out:
+        out.write(HEADER.pack(INDEX_MAGIC, block_size, 0, st.st_size, st.st_mtime_ns, len(names)))
+        for a in (offsets, name_offsets):
+            if sys.byteorder != 'little':
+                a.byteswap()
+            a.tofile(out)
+        for name in names:
+            out.write(name)
+    return len(names)
+
+class SummaryIndex:
+    def __init__(self, filename, indexname=None):
+        if indexname is None:
+            indexname = index_filename(filename)
+        self.fil = open(filename, 'rb')
+        self.idx = open(indexname, 'rb')
+        self.map = mmap.mmap(self.idx.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.block_size, pad, size, mtime_ns, self.nblocks = HEADER.unpack_from(self.map, 0)
+        st = os.fstat(self.fil.fileno())
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError('not a summary index: ' + indexname)
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            self.close()
+            raise ValueError('the index %s is out of date, rebuild it with: summary_index.py build %s' % (indexname, filename))
+        pos = HEADER.size
+        self.offsets = self.section(pos, self.nblocks)
+        pos += 8 * self.nblocks
+        self.name_offsets = self.section(pos, self.nblocks + 1)
+        pos += 8 * (self.nblocks + 1)
+        self.names = pos
+
+    def section(self, pos, n):
+        a = array.array('Q')
+        a.frombytes(self.map[pos:pos + 8 * n])
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a
+
+    def close(self):
+        self.map.close()
+        self.idx.close()
+        self.fil.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def block_host(self, i):
+        return str(self.map[self.names + self.name_offsets[i]:self.names + self.name_offsets[i + 1]], 'utf-8')
+
+    # offset of the last block whose first host is smaller than host (the lines of host
+    # can start at the end of that block), 0 if there is none
+    def start_offset(self, host):
+        lo, hi = 0, self.nblocks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.block_host(mid) < host:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.offsets[lo - 1] if lo > 0 else 0
+
+    # returns (host, line) for the lines whose host is in [start, end[ (no end if end is None)
+    def lines(self, start, end=None):
+        self.fil.seek(self.start_offset(start))
+        for bline in self.fil:
+            line = bline.decode('utf-8', errors="ignore")
+            host = host_of(line)
+            if host < start:
+                continue
+            if end is not None and host >= end:
+                break
+            yield host, line
+
+    # returns (host, line) for the lines whose host starts with prefix
+    def prefix(self, prefix):
+        for host, line in self.lines(prefix):
+            if not host.startswith(prefix):
+                break
+            yield host, line
+
+    # returns the line of host or None
+    def get(self, host):
+        for h, line in self.lines(host):
+            if h == host:
+                return line
+            break
+        return None
+
+    # returns the entry of host as in the .summary file ({"year": {"n_XXX": A, ...}}) or None
+    def lookup(self, host):
+        line = self.get(host)
+        if line is None:
+            return None
+        return json.loads(line[len(host) + 1:])
+
+    # returns a dictionary host -> entry for the hosts that were found
+    def lookup_many(self, hosts):
+        ret = {}
+        for host in sorted(set(hosts)):
+            entry = self.lookup(host)
+            if entry is not None:
+                ret[host] = entry
+        return ret
+
+# same interface as SummaryIndex for a binary summary file, which needs no index
+class BinaryIndex:
+    def __init__(self, filename):
+        self.reader = summary_file.SummaryReader(filename)
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    # the lines are the ones of the JSONL summary file
+    def lines(self, start, end=None):
+        for i in range(self.reader.bisect(start), len(self.reader)):
+            host = self.reader.host(i)
+            if end is not None and host >= end:
+                break
+            yield host, host + ' ' + json.dumps(entry_as_dict(self.reader.entries(i))) + '\n'
+
+    prefix = SummaryIndex.prefix
+    get = SummaryIndex.get
+
+    def lookup(self, host):
+        i = self.reader.find(host)
+        if i < 0:
+            return None
+        return entry_as_dict(self.reader.entries(i))
+
+    lookup_many = SummaryIndex.lookup_many
+
+def entry_as_dict(dates):
+    return {date: mime_counter.as_dict(counter) for date, counter in dates}
+
+# returns the index of a summary file, binary summary files are their own index
+def open_index(filename):
+    if summary_file.is_binary(filename):
+        return BinaryIndex(filename)
+    return SummaryIndex(filename)
+
+# returns the entry of host in a summary file or None
+def lookup(filename, host):
+    with open_index(filename) as index:
+        return index.lookup(host)
+
+def dolookup(args):
+    with open_index(args.file) as index:
+        if args.range:
+            for host, line in index.lines(args.host[0], args.host[1] if len(args.host) > 1 else None):
+                sys.stdout.write(line)
+            return
+        for host in args.host:
+            found = False
+            if args.prefix:
+                for h, line in index.prefix(host):
+                    sys.stdout.write(line)
+                    found = True
+            else:
+                line = index.get(host)
+                if line is not None:
+                    sys.stdout.write(line)
+                    found = True
+            if not found:
+                print_to_stderr("Not found:", host)
+
+def dobuild(args):
+    for f in args.file:
+        try:
+            nblocks = build_index(f, block_size=args.block_size)
+            print_to_stderr(index_filename(f) + ':', nblocks, 'blocks')
+        except Exception as inst:
+            print_to_stderr("Error", inst, f)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build a sidecar index for sorted summary files and look up hosts in them')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='write the index FILE.idx of each sorted summary file')
+    build.add_argument('--block_size', type=int, default=BLOCK_SIZE, help='one index entry per block of this many bytes of the summary file (default 4096)')
+    build.add_argument('file', nargs='+', help='sorted summary file (can be several)')
+    find = sub.add_parser('lookup', help='output the lines of the summary file for the given hosts')
+    find.add_argument('--prefix', action="store_true", help='output all the hosts starting with each given host')
+    find.add_argument('--range', action="store_true", help='output all the hosts from the first given host (included) to the second one (excluded, no end if omitted)')
+    find.add_argument('file', help='sorted summary file with its index, or binary summary file')
+    find.add_argument('host', nargs='+', help='host (can be several)')
+    args = parser.parse_args()
+    if args.command == 'build':
+        dobuild(args)
+    else:
+        try:
+            dolookup(args)
+        except Exception as inst:
+            print_to_stderr("Error", inst, args.file)
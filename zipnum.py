@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# ZipNum clusters
+# A ZipNum cluster is a set of sorted cdx shard files made of gzip members (blocks of a few
+# thousand lines) with a secondary index (.idx) that has one line per block, with the first
+# key of the block and its place in the shard:
+#   SURT TIMESTAMP<tab>SHARD<tab>OFFSET<tab>LENGTH[<tab>...]
+# and an optional location file (.loc) with the path of each shard:
+#   SHARD<tab>PATH[<tab>...]
+# Without a location file, the shards are SHARD.gz next to the secondary index. Relative
+# paths are relative to the directory of the location file.
+
+import sys
+import os
+
+# IDX_KEY etc: fields of a block
+IDX_KEY     = 0
+IDX_SHARD   = 1
+IDX_OFFSET  = 2
+IDX_LENGTH  = 3
+# cdx lines compress about this many times, used to make tasks of about chunk_size uncompressed bytes
+COMPRESSION_RATIO = 6
+
+def print_to_stderr(*a):
+    print(*a, file = sys.stderr)
+
+# returns the list of blocks (key, shard, offset, length) of the secondary index
+def read_idx(filename):
+    blocks = []
+    with open(filename, 'r', encoding='utf-8') as fil:
+        for line in fil:
+            fields = line.rstrip('\r\n').split('\t')
+            try:
+                blocks.append((fields[0], fields[1], int(fields[2]), int(fields[3])))
+            except (IndexError, ValueError):
+                print_to_stderr("Invalid line in", filename, line)
+    return blocks
+
+# returns the dictionary shard -> path of the location file
+def read_loc(filename):
+    paths = {}
+    base = os.path.dirname(filename)
+    with open(filename, 'r', encoding='utf-8') as fil:
+        for line in fil:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) > 1 and not fields[0] in paths:
+                paths[fields[0]] = os.path.join(base, fields[1])
+    return paths
+
+# returns the path of each shard of the blocks
+def shard_paths(idxname, blocks, locname=None):
+    if locname is None and os.path.exists(os.path.splitext(idxname)[0] + '.loc'):
+        locname = os.path.splitext(idxname)[0] + '.loc'
+    paths = read_loc(locname) if locname else {}
+    base = os.path.dirname(idxname)
+    for block in blocks:
+        if not block[IDX_SHARD] in paths:
+            paths[block[IDX_SHARD]] = os.path.join(base, block[IDX_SHARD] + '.gz')
+    return paths
+
+# returns the blocks that can have lines with keys in one of the ranges [start, end[ (end None:
+# no limit) of key_ranges (None: all the blocks). Block i has the keys from its first key to the first
+# key of block i + 1 (included, as a key can continue in the next block)
+def select_blocks(blocks, key_ranges=None):
+    if key_ranges is None:
+        return blocks
+    ret = []
+    for i, block in enumerate(blocks):
+        for start, end in key_ranges:
+            if (end is None or block[IDX_KEY] < end) and (i + 1 == len(blocks) or blocks[i + 1][IDX_KEY] >= start):
+                ret.append(block)
+                break
+    return ret
+
+# returns the (path, start, end) byte ranges of runs of consecutive blocks of the same shard,
+# of at most max_length compressed bytes (or a single block)
+def block_ranges(blocks, paths, max_length):
+    ranges = []
+    for block in blocks:
+        path = paths[block[IDX_SHARD]]
+        start = block[IDX_OFFSET]
+        end = start + block[IDX_LENGTH]
+        if ranges and ranges[-1][0] == path and ranges[-1][2] == start and end - ranges[-1][1] <= max_length:
+            ranges[-1] = (path, ranges[-1][1], end)
+        else:
+            ranges.append((path, start, end))
+    return ranges